@@ -0,0 +1,158 @@
+
+# Benchmarks for MangoServer, run against a scratch SQLite database
+#
+#  $ python benchmarks.py startup [--runs N]
+#  $ python benchmarks.py ingest [--runs N] [--count N] [--backend mongo]
+#
+# Each benchmark prints its timings, in milliseconds, as JSON
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from io import BytesIO
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def wsgi_call(app, method, path, body="", headers={}):
+    # Call app directly, returning (status, body)
+    env = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': '',
+           'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080', 'SERVER_PROTOCOL': 'HTTP/1.1',
+           'CONTENT_LENGTH': str(len(body)), 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+           'wsgi.input': BytesIO(body), 'wsgi.errors': sys.stderr, 'wsgi.multithread': False,
+           'wsgi.multiprocess': False, 'wsgi.run_once': False}
+    for (k, v) in headers.items():
+        k = k.upper().replace('-', '_')
+        env[k if k == 'CONTENT_TYPE' else 'HTTP_' + k] = v
+    status = []
+    out = app(env, lambda s, h, e=None: status.append(s))
+    data = out.read() if hasattr(out, 'read') else ''.join(out)
+    if hasattr(out, 'close'):
+        out.close()
+    return (status[0], data)
+
+def scratch_config(tmp):
+    # A config.json for a SQLite database in tmp
+    path = os.path.join(tmp, 'config.json')
+    fh = file(path, 'w')
+    fh.write(json.dumps({"backend": "sqlite", "sqlite_path": os.path.join(tmp, 'mango.sqlite'),
+        "url_host": "http://localhost:8080"}))
+    fh.close()
+    return path
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+# Run in a fresh interpreter for each startup measurement
+startup_child = """
+import os, sys, json, time
+start = time.time()
+import mangoserver
+app = mangoserver.application
+imported = time.time()
+from benchmarks import wsgi_call
+hdrs = {'Content-Type': 'application/ld+json'}
+wsgi_call(app, 'PUT', '/bench/', json.dumps({'type': 'AnnotationCollection'}), hdrs)
+wsgi_call(app, 'POST', '/bench/', json.dumps({'type': 'Annotation', 'target': 'http://example.org/'}), hdrs)
+created = time.time()
+wsgi_call(app, 'GET', '/bench/')
+first_json = time.time()
+wsgi_call(app, 'GET', '/bench/', headers={'Accept': 'text/turtle'})
+first_rdf = time.time()
+print json.dumps({'import': imported - start, 'first_json': first_json - created,
+    'first_rdf': first_rdf - first_json})
+"""
+
+def bench_startup(options):
+    # Time to import the WSGI module (as mod_wsgi does, building the app
+    # from config), then the first JSON and the first Turtle GETs
+    results = {}
+    for preload in [False, True]:
+        runs = []
+        for x in range(options.runs):
+            tmp = tempfile.mkdtemp()
+            config = scratch_config(tmp)
+            if preload:
+                conf = json.loads(file(config).read())
+                conf['preload'] = True
+                file(config, 'w').write(json.dumps(conf))
+            env = dict(os.environ, MANGO_CONFIG=config, PYTHONPATH=here)
+            out = subprocess.check_output([sys.executable, '-c', startup_child], cwd=tmp, env=env)
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+            for fn in os.listdir(tmp):
+                os.remove(os.path.join(tmp, fn))
+            os.rmdir(tmp)
+        results['preload' if preload else 'lazy'] = dict(
+            [(k, round(median([r[k] for r in runs]) * 1000, 1)) for k in ['import', 'first_json', 'first_rdf']])
+    return results
+
+def index_size(store, container):
+    # Bytes in the index over annotation ids
+    if hasattr(store, 'path'):
+        try:
+            rows = store._conn().execute("SELECT SUM(pgsize) FROM dbstat WHERE name=?",
+                ('sqlite_autoindex_annotations_1',)).fetchone()
+        except Exception:
+            # SQLite built without dbstat
+            return None
+        return rows[0]
+    return store.connection.command('collStats', container)['indexSizes']['_id_']
+
+def bench_ingest(options):
+    # Insert count annotations one at a time, as POST does, with each way
+    # of minting ids: 'uri' is how ids were stored before, the full URI of
+    # a uuid4
+    from mangostore import backends
+    from mangoserver import id_strategies
+    base = "http://localhost:8080/bench/"
+    strategies = dict(id_strategies)
+    strategies['uri'] = lambda: base + id_strategies['uuid4']()
+    results = {}
+    for (name, mint) in sorted(strategies.items()):
+        runs = []
+        for x in range(options.runs):
+            tmp = tempfile.mkdtemp()
+            if options.backend == 'mongo':
+                store = backends['mongo'](database="mango_bench")
+            else:
+                store = backends['sqlite'](path=os.path.join(tmp, 'mango.sqlite'))
+            store.drop_container('bench')
+            store.create_container('bench', {'type': 'AnnotationCollection'})
+            start = time.time()
+            for n in range(options.count):
+                store.insert('bench', {'_id': mint(), '_etag': 'x', 'type': 'Annotation',
+                    'body': {'value': 'Annotation %s' % n}, 'target': 'http://example.org/%s' % n})
+            took = time.time() - start
+            runs.append((options.count / took, index_size(store, 'bench')))
+            store.drop_container('bench')
+            for fn in os.listdir(tmp):
+                os.remove(os.path.join(tmp, fn))
+            os.rmdir(tmp)
+        results[name] = {'per_second': round(median([r[0] for r in runs]), 1),
+            'index_bytes': runs[0][1]}
+    return results
+
+benchmarks = {'startup': bench_startup, 'ingest': bench_ingest}
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] " + "|".join(sorted(benchmarks)))
+    parser.add_option('--runs', dest="runs", default=5, type=int,
+                      help="Number of runs to take the median of")
+    parser.add_option('--count', dest="count", default=20000, type=int,
+                      help="Annotations to insert, for ingest")
+    parser.add_option('--backend', dest="backend", default="sqlite",
+                      help="Store to ingest into: 'sqlite', or 'mongo' on localhost")
+    options, args = parser.parse_args()
+    names = args or sorted(benchmarks)
+    for name in names:
+        if not name in benchmarks:
+            parser.error("Unknown benchmark: %s" % name)
+        print json.dumps({name: benchmarks[name](options)}, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
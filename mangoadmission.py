@@ -0,0 +1,118 @@
+
+# Admission control for MangoServer
+#
+# Requests are admitted, or shed with a 503 and Retry-After, before any
+# work is done for them. Limits are on requests in flight (in total, by
+# cost class, per container and per client) and on request rates (per
+# container and per client, with token buckets). Counts are per process.
+
+import math
+import time
+import threading
+from collections import OrderedDict
+
+defaults = {
+    'max_in_flight': None,          # requests in flight
+    'rdf_in_flight': None,          # ... that parse or serialize RDF
+    'json_in_flight': None,         # ... that don't
+    'container_in_flight': None,    # ... per container
+    'client_in_flight': None,       # ... per client address
+    'container_rate': None,         # requests per second, per container
+    'client_rate': None,            # requests per second, per client
+    'burst': 5,                     # seconds of rate that can be used at once
+    'rdf_cost': 5,                  # RDF requests count as this many towards rates
+    'retry_after': 1,               # seconds, when shed for concurrency
+    'max_buckets': 10000            # least recently used rate buckets are dropped beyond this
+}
+
+
+class Admission(object):
+
+    def __init__(self, limits=None):
+        self.limits = defaults.copy()
+        self.limits.update(limits or {})
+        for (k, v) in self.limits.items():
+            if not k in defaults:
+                raise ValueError("Unknown admission limit: %s" % k)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.buckets = OrderedDict()
+        self.admitted = 0
+        self.shed = {}
+
+    def enabled(self):
+        return any([v for (k, v) in self.limits.items() if k.endswith('_in_flight') or k.endswith('_rate')])
+
+    def _bucket(self, key, rate, now):
+        # [tokens, last refill] for key, refilled up to now, and moved to
+        # the most recently used end
+        capacity = rate * self.limits['burst']
+        b = self.buckets.pop(key, None)
+        if b is None:
+            if len(self.buckets) >= self.limits['max_buckets']:
+                self.buckets.popitem(last=False)
+            b = [capacity, now]
+        else:
+            b[0] = min(capacity, b[0] + (now - b[1]) * rate)
+            b[1] = now
+        self.buckets[key] = b
+        return b
+
+    def admit(self, container, client, cls):
+        # Returns (held, None) when admitted, to be passed to release(),
+        # or (None, (reason, retry_after)) when shed
+        lim = self.limits
+        cost = lim['rdf_cost'] if cls == 'rdf' else 1
+        held = [('all',), ('class', cls), ('container', container), ('client', client)]
+        caps = ['max_in_flight', cls + '_in_flight', 'container_in_flight', 'client_in_flight']
+        rates = [(('container', container), lim['container_rate']), (('client', client), lim['client_rate'])]
+
+        with self.lock:
+            now = time.time()
+            shed = None
+            buckets = []
+            for (key, cap) in zip(held, caps):
+                if lim[cap] and self.in_flight.get(key, 0) >= lim[cap]:
+                    shed = (cap, lim['retry_after'])
+                    break
+            if not shed:
+                for (key, rate) in rates:
+                    if rate:
+                        b = self._bucket(key, rate, now)
+                        # An RDF request costing more than the burst needs a
+                        # full bucket, and leaves it owing the rest
+                        need = min(cost, rate * lim['burst'])
+                        if b[0] < need:
+                            shed = (key[0] + '_rate', int(math.ceil((need - b[0]) / float(rate))))
+                            break
+                        buckets.append(b)
+            if shed:
+                self.shed[shed[0]] = self.shed.get(shed[0], 0) + 1
+                return (None, shed)
+
+            for b in buckets:
+                b[0] -= cost
+            for key in held:
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+            self.admitted += 1
+        return (held, None)
+
+    def release(self, held):
+        with self.lock:
+            for key in held:
+                n = self.in_flight.get(key, 0) - 1
+                if n > 0:
+                    self.in_flight[key] = n
+                else:
+                    self.in_flight.pop(key, None)
+
+    def metrics(self):
+        with self.lock:
+            shed = self.shed.copy()
+            return {'admitted': self.admitted,
+                'shed': shed,
+                'shed_total': sum(shed.values()),
+                'in_flight': self.in_flight.get(('all',), 0),
+                'in_flight_rdf': self.in_flight.get(('class', 'rdf'), 0),
+                'in_flight_json': self.in_flight.get(('class', 'json'), 0),
+                'limits': self.limits.copy()}
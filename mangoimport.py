@@ -0,0 +1,333 @@
+
+# Bulk import of annotations from large N-Triples or Turtle files
+#
+# Pass 1 reads the file a statement at a time, parsing bounded chunks with
+# rdflib and spooling the triples into an on-disk SQLite table, so memory
+# doesn't grow with the file.
+# Pass 2 pulls out one subgraph per oa:Annotation (its blank nodes, and
+# the bodies, targets, selectors etc it points to), frames and compacts
+# it as for a single annotation, and inserts the results in batches.
+# A checkpoint is written after every batch, and re-running with the same
+# checkpoint picks up where it stopped.
+
+import io
+import os
+import re
+import json
+import uuid
+import sqlite3
+
+from rdflib import Graph, BNode, URIRef
+
+RDF_TYPE = u'<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+OA_ANNOTATION = u'<http://www.w3.org/ns/oa#Annotation>'
+
+# Labelled blank nodes are rewritten into this namespace while parsing, so
+# the same label means the same node in every chunk
+BNODE_NS = u'urn:x-mango-bnode:'
+
+# Named resources that are part of an annotation's description, as well as
+# any blank node
+FOLLOW = set([u'<http://www.w3.org/ns/oa#%s>' % x for x in
+    ['hasBody', 'hasTarget', 'hasSelector', 'hasSource', 'hasState', 'refinedBy',
+     'styledBy', 'hasStartSelector', 'hasEndSelector', 'hasScope']] +
+    [u'<http://www.w3.org/ns/activitystreams#items>'])
+
+bnode_label = re.compile(r'_:([A-Za-z0-9_](?:[A-Za-z0-9_.\-]*[A-Za-z0-9_\-])?)')
+sparql_directive = re.compile(r'(?i)(PREFIX|BASE)\s')
+
+
+def _bnode_iri(match):
+    return u'<%s%s>' % (BNODE_NS, match.group(1))
+
+def ntriples_statements(fh):
+    # Each line of N-Triples is a statement; yields (False, statement)
+    for line in fh:
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if line.find('"') > -1:
+            # Object is a literal, so only the subject can be a blank node
+            head = len(line) - len(line.lstrip())
+            m = bnode_label.match(line, head)
+            if m:
+                line = _bnode_iri(m) + line[m.end():]
+        else:
+            line = bnode_label.sub(_bnode_iri, line)
+        yield (False, line)
+
+def turtle_statements(fh):
+    # Split a Turtle document into top level statements, without parsing
+    # it; yields (is_directive, statement)
+    buf = []
+    depth = 0
+    mode = None
+    quote = ''
+    sparql = False
+    started = False
+    last = ' '
+    for line in fh:
+        i = 0
+        n = len(line)
+        while i < n:
+            c = line[i]
+            if mode == 'iri':
+                buf.append(c)
+                i += 1
+                if c == '>':
+                    mode = None
+                    last = c
+                    if sparql and depth == 0:
+                        yield (True, u''.join(buf) + u'\n')
+                        buf = []
+                        sparql = False
+                        started = False
+                continue
+            elif mode == 'str':
+                if c == '\\':
+                    buf.append(line[i:i+2])
+                    i += 2
+                elif line.startswith(quote, i):
+                    buf.append(quote)
+                    i += len(quote)
+                    mode = None
+                    last = '"'
+                else:
+                    buf.append(c)
+                    i += 1
+                continue
+
+            if c == '#':
+                buf.append(u'\n')
+                break
+            if not started and not c.isspace():
+                started = True
+                sparql = sparql_directive.match(line, i) is not None
+
+            if c == '<':
+                mode = 'iri'
+            elif c in '"\'':
+                quote = c * 3 if line.startswith(c * 3, i) else c
+                buf.append(quote)
+                i += len(quote)
+                mode = 'str'
+                continue
+            elif c in '[(':
+                depth += 1
+            elif c in '])':
+                depth -= 1
+            elif c == '_' and (last.isspace() or last in '([,;') and line.startswith('_:', i):
+                m = bnode_label.match(line, i)
+                if m:
+                    buf.append(_bnode_iri(m))
+                    i = m.end()
+                    last = '>'
+                    continue
+            elif c == '.' and depth == 0 and (i + 1 == n or line[i+1] in ' \t\r\n#'):
+                buf.append(c)
+                stmt = u''.join(buf)
+                head = stmt.lstrip()[:5].lower()
+                yield (head in ['@pref', '@base'], stmt + u'\n')
+                buf = []
+                started = False
+                last = ' '
+                i += 1
+                continue
+            buf.append(c)
+            last = c
+            i += 1
+    if started:
+        raise ValueError("Unterminated statement at end of file: %s" % u''.join(buf)[:200])
+
+
+class TripleSpool(object):
+    # On-disk triples, as N-Triples terms, indexed by subject
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS triples (
+                s TEXT NOT NULL, p TEXT NOT NULL, o TEXT NOT NULL, UNIQUE (s, p, o))""")
+
+    def _term(self, t):
+        if isinstance(t, BNode):
+            return u'_:' + t
+        elif isinstance(t, URIRef) and t.startswith(BNODE_NS):
+            return u'_:' + t[len(BNODE_NS):]
+        return t.n3()
+
+    def add_graph(self, g):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO triples (s, p, o) VALUES (?,?,?)",
+                [(self._term(s), self._term(p), self._term(o)) for (s, p, o) in g])
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM triples")
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+
+    def annotations(self, after=None, limit=None):
+        # The annotation subjects after the given one, in order, at most
+        # limit of them
+        q = "SELECT DISTINCT s FROM triples WHERE p=? AND o=?"
+        params = [RDF_TYPE, OA_ANNOTATION]
+        if after:
+            q += " AND s>?"
+            params.append(after)
+        q += " ORDER BY s"
+        if limit:
+            q += " LIMIT ?"
+            params.append(limit)
+        return [r[0] for r in self.conn.execute(q, params)]
+
+    def count_annotations(self, after=None):
+        q = "SELECT COUNT(DISTINCT s) FROM triples WHERE p=? AND o=?"
+        params = [RDF_TYPE, OA_ANNOTATION]
+        if after:
+            q += " AND s>?"
+            params.append(after)
+        return self.conn.execute(q, params).fetchone()[0]
+
+    def is_annotation(self, node):
+        return self.conn.execute("SELECT 1 FROM triples WHERE s=? AND p=? AND o=?",
+            (node, RDF_TYPE, OA_ANNOTATION)).fetchone() is not None
+
+    def subgraph(self, subject):
+        # Turtle for the annotation and everything that describes it,
+        # stopping at other annotations
+        lines = []
+        seen = set([subject])
+        todo = [subject]
+        while todo:
+            s = todo.pop()
+            for (p, o) in self.conn.execute("SELECT p, o FROM triples WHERE s=?", (s,)).fetchall():
+                lines.append(u"%s %s %s .\n" % (s, p, o))
+                if o in seen or not (o.startswith('_:') or (p in FOLLOW and o.startswith('<'))):
+                    continue
+                seen.add(o)
+                if not self.is_annotation(o):
+                    todo.append(o)
+        return u"".join(lines)
+
+    def close(self):
+        self.conn.close()
+
+
+def _save(path, state):
+    tmp = path + ".tmp"
+    fh = open(tmp, 'w')
+    fh.write(json.dumps(state))
+    fh.close()
+    os.rename(tmp, path)
+
+def import_rdf(server, container, source, format=None, checkpoint=None,
+               batch_size=500, chunk_statements=10000, progress=None):
+    # Import every oa:Annotation in source into container, returning the
+    # checkpoint state: counts of imported, existing (already imported, ids
+    # are derived from the annotation's IRI, or for a blank node from the
+    # source file and its label) and failed annotations
+    if not progress:
+        progress = lambda msg: None
+    if format is None:
+        format = 'nt' if source.endswith('.nt') else 'turtle'
+    if not format in ['nt', 'turtle']:
+        raise ValueError("Unknown format: %s" % format)
+    if server.store.get_metadata(container) is None:
+        raise ValueError("Unknown container: %s" % container)
+
+    checkpoint = checkpoint or source + ".import-checkpoint"
+    state = None
+    if os.path.exists(checkpoint):
+        fh = open(checkpoint)
+        state = json.loads(fh.read())
+        fh.close()
+        if state.get('source') != source or state.get('container') != container:
+            raise ValueError("Checkpoint %s is for a different import" % checkpoint)
+    if not state:
+        state = {'source': source, 'container': container, 'loaded': False,
+                 'last': None, 'imported': 0, 'existing': 0, 'failed': 0}
+    spool = TripleSpool(checkpoint + ".triples")
+    # Blank node labels are only unique within their file
+    bnode_scope = os.path.abspath(source).encode('utf-8') + '#'
+
+    try:
+        if not state['loaded']:
+            # Pass 1: spool the triples to disk
+            spool.clear()
+            fh = io.open(source, encoding='utf-8')
+            splitter = ntriples_statements if format == 'nt' else turtle_statements
+            directives = []
+            stmts = []
+            for (directive, stmt) in splitter(fh):
+                if directive:
+                    directives.append(stmt)
+                    continue
+                stmts.append(stmt)
+                if len(stmts) >= chunk_statements:
+                    g = Graph()
+                    g.parse(data=u"".join(directives + stmts), format='turtle')
+                    spool.add_graph(g)
+                    stmts = []
+                    progress("Read %s triples" % spool.count())
+            if stmts:
+                g = Graph()
+                g.parse(data=u"".join(directives + stmts), format='turtle')
+                spool.add_graph(g)
+            fh.close()
+            state['loaded'] = True
+            _save(checkpoint, state)
+            progress("Read %s triples" % spool.count())
+
+        # Pass 2: frame and insert each annotation, a batch of subjects at
+        # a time
+        total = spool.count_annotations(state['last'])
+        progress("%s annotations to import" % total)
+        done = 0
+        while True:
+            subjects = spool.annotations(state['last'], batch_size)
+            if not subjects:
+                break
+            batch = []
+            for subject in subjects:
+                try:
+                    g = Graph()
+                    g.parse(data=spool.subgraph(subject), format='turtle')
+                    js = server._frame_graph(g)
+                    if '@graph' in js:
+                        js = js['@graph'][0]
+                    js['@context'] = server.default_context
+                    name = subject.encode('utf-8')
+                    if subject.startswith('_:'):
+                        name = bnode_scope + name
+                    else:
+                        js['id'] = subject[1:-1]
+                    js = server._fix_json(js, via=True)
+                    myid = str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+                    uri = server._make_uri(container, myid)
+                    js = server.decorate_annotation(js, uri)
+                    js['_id'] = myid
+                    js['_etag'] = server._new_etag()
+                    batch.append(js)
+                except Exception, e:
+                    state['failed'] += 1
+                    progress("Failed %s: %s" % (subject, e))
+
+            if batch:
+                inserted = server.store.insert_many(container, batch)
+                state['imported'] += inserted
+                state['existing'] += len(batch) - inserted
+            state['last'] = subjects[-1]
+            _save(checkpoint, state)
+            done += len(subjects)
+            progress("Imported %s of %s annotations" % (done, total))
+        if done:
+            server.store.invalidate_stats(container)
+            server.update_container_modified(container)
+    finally:
+        spool.close()
+    # Finished with, the checkpoint alone records the import
+    os.remove(spool.path)
+    return state
@@ -3,23 +3,40 @@
 # All URLs that end in a / are containers
 # All containers are Mongo collections, regardless of where they appear in the tree
 # All resources are in the appropriate collection
+# ... unless storage_layout is "shared", in which case all resources are in one
+# collection keyed by (container, id) and container metadata is in another
+# Storage itself is behind the Store interface in mangostore, so the
+# "sqlite" backend can stand in for Mongo on single node installs
 
+import os
+import sys
 import json
+import urllib
+from io import BytesIO
 from functools import partial
 import uuid
 import datetime
 import time
 import hashlib
+import threading
 from collections import OrderedDict
 
-from bottle import Bottle, route, run, request, response, abort, error, redirect
+from bottle import Bottle, route, run, request, response, abort, error, redirect, HTTPError
 
 # Requires pymongo 3.x
 from bson import ObjectId
-from pymongo import MongoClient
-from rdflib import Graph
-from pyld import jsonld
-from pyld.jsonld import compact, expand, frame
+
+from mangostore import backends, patch_formats, parse_patch, PatchError, \
+    stats_delta
+from mangoadmission import Admission
+
+# rdflib and pyld are slow to import, and only needed for RDF in or out,
+# so they're loaded by load_rdf() on first use rather than at startup
+Graph = None
+jsonld = None
+
+# Files are relative to the module, not the working directory
+here = os.path.dirname(os.path.abspath(__file__))
 
 # Stop code from looking up the contexts online EVERY TIME
 docCache = {}
@@ -27,6 +44,47 @@ docCache = {}
 def now():
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
+# Time ordered ids, so new annotations are appended to the end of the _id
+# index rather than scattered through it: milliseconds since the epoch then
+# random bits (74 for uuid7, 80 for ulid), which are incremented for ids in
+# the same millisecond
+_id_lock = threading.Lock()
+_id_last = {}
+crockford = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def _time_ordered(bits):
+    with _id_lock:
+        ms = int(time.time() * 1000)
+        (last_ms, last_rnd) = _id_last.get(bits, (0, 0))
+        if ms <= last_ms:
+            (ms, rnd) = (last_ms, last_rnd + 1)
+        else:
+            rnd = int(os.urandom(10).encode('hex'), 16) >> (80 - bits)
+        _id_last[bits] = (ms, rnd)
+    return (ms, rnd)
+
+def uuid7():
+    # Same shape as a uuid4: version 7 with the random bits split around the variant
+    (ms, rnd) = _time_ordered(74)
+    value = (ms << 80) | (7 << 76) | ((rnd >> 62) << 64) | (2 << 62) | (rnd & ((1 << 62) - 1))
+    return str(uuid.UUID(int=value))
+
+def ulid():
+    # 26 characters of Crockford base32
+    (ms, rnd) = _time_ordered(80)
+    value = (ms << 80) | rnd
+    chars = []
+    for x in range(26):
+        chars.append(crockford[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+id_strategies = {
+    'uuid4': lambda: str(uuid.uuid4()),
+    'uuid7': uuid7,
+    'ulid': ulid
+}
+
 def load_document_local(url):
     if docCache.has_key(url):
         return docCache[url]
@@ -42,14 +100,21 @@ def load_document_local(url):
         fn = "contexts/context_oa.json"
     elif url in ['http://www.w3.org/ns/anno.jsonld']:
         fn = "contexts/context_wawg.json"
-    fh = file(fn)
+    fh = file(os.path.join(here, fn))
     data = fh.read()
     fh.close()
     doc['document'] = data;
     docCache[url] = doc
     return doc
 
-jsonld.set_document_loader(load_document_local)
+def load_rdf():
+    global Graph, jsonld
+    if jsonld is None:
+        from rdflib import Graph as rdflib_graph
+        from pyld import jsonld as pyld_jsonld
+        pyld_jsonld.set_document_loader(load_document_local)
+        Graph = rdflib_graph
+        jsonld = pyld_jsonld
 
 class MongoEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -63,13 +128,30 @@ class MangoServer(object):
 
     def __init__(self, database="mango", host='localhost', port=27017,
                  sort_keys=True, human_sort_keys=True, compact_json=False, indent_json=2,
-                 url_host="http://localhost:8000/", url_prefix="", json_ld=True):
+                 url_host="http://localhost:8000/", url_prefix="", json_ld=True,
+                 storage_layout="collection", backend="mongo", sqlite_path="mango.sqlite",
+                 publish_dir=None, admission=None, id_strategy="uuid7", max_body_size=1048576):
 
-        # Mongo Connection
-        self.mongo_host = host
-        self.mongo_port = port
-        self.mongo_db = database
-        self.connection = self._connect(database, host, port)
+        self._container_desc_id = "__container_metadata__"
+        self._batch_id = "__batch__"
+        self._stats_id = "__stats__"
+        self._metrics_id = "__metrics__"
+        self._rebuilding = set()
+        self._rebuilding_lock = threading.Lock()
+
+        # How new resource ids are minted, see id_strategies
+        if not id_strategy in id_strategies:
+            raise ValueError("Unknown id_strategy: %s" % id_strategy)
+        self.id_strategy = id_strategy
+
+        # Storage
+        if backend == 'mongo':
+            self.store = backends[backend](database=database, host=host, port=port,
+                storage_layout=storage_layout, desc_id=self._container_desc_id)
+        elif backend == 'sqlite':
+            self.store = backends[backend](path=sqlite_path)
+        else:
+            raise ValueError("Unknown backend: %s" % backend)
 
         # JSON Serialization options
         self.sort_keys = sort_keys
@@ -88,15 +170,25 @@ class MangoServer(object):
         self.url_prefix = url_prefix
         self.server_identity = {"type": "Software", "label": "MangoServer v0.9", "homepage": "https://github.com/azaroth42/MangoServer/"}
 
-        self._container_desc_id = "__container_metadata__"
         self.json_ld_profile = "http://www.w3.org/ns/anno.jsonld"
         self.default_context = "http://www.w3.org/ns/anno.jsonld"
         self.uri_page_size = 500
         self.description_page_size = 10
+        self.batch_max_items = 500
+        self.max_body_size = max_body_size
         self.server_prefers = "description"
         self.require_if_match = False # For testing Mirador
 
-        fh = file('contexts/annotation_frame.jsonld')
+        # Static publishing, see publish()
+        self.publish_dir = publish_dir
+        self.publish_variants = {'jsonld': '', 'ttl': 'text/turtle'}
+        self.publish_headers = ['Content-Type', 'ETag', 'Link', 'Content-Location', 'Accept-Patch']
+        self._manifests = {}
+
+        # Load shedding, see mangoadmission for the limits
+        self.admission = Admission(admission)
+
+        fh = file(os.path.join(here, 'contexts/annotation_frame.jsonld'))
         data = fh.read()
         fh.close()
         self.annoframe = json.loads(data)
@@ -155,16 +247,6 @@ class MangoServer(object):
         self.key_order_hash['items'] = 5000
         self.key_order_hash['contains'] = 5001
 
-    def _connect(self, database, host=None, port=None):
-        return MongoClient(host=host, port=port)[database]
-
-    def _collection(self, container):
-        if not self.connection:
-            self.connection = self._connect(self.mongo_db, self.mongo_host, self.mongo_port)
-
-        container = self.connection[container]
-        return container
-
     def _make_uri(self, container, resource=""):
         return "%s/%s%s/%s" % (self.url_host, self.url_prefix, container, resource)
 
@@ -175,6 +257,8 @@ class MangoServer(object):
         if value.find('%') > -1: return False
         if value.find('?') > -1: return False
         if value == self._container_desc_id: return False
+        if value == self._batch_id: return False
+        if value == self._stats_id: return False
         value = value.replace(' ', '+')
         value = value.replace('[', '')
         value = value.replace(']', '')
@@ -183,13 +267,11 @@ class MangoServer(object):
     def _make_id(self, container, resource=""):
         if not resource:
             # Create new id, maybe using slug
-            resource = str(uuid.uuid4())
+            resource = id_strategies[self.id_strategy]()
             slug = self._slug_ok(request.headers.get('slug', ''))
             if slug:
                 # make sure it doesn't already exist
-                coll = self._collection(container)
-                exists = coll.find_one({"_id": slug})
-                if not exists:
+                if not self.store.exists(container, slug):
                     resource = slug                
         return resource
 
@@ -212,50 +294,84 @@ class MangoServer(object):
                 new[k] = v
         return new
 
-    def _rdf_to_jsonld(self, b):
-        fmt = request.headers['Content-Type']
+    def _rdf_to_jsonld(self, b, fmt):
         if self.rdflib_format_map.has_key(fmt):
             rdftype = self.rdflib_format_map[fmt]
+            load_rdf()
             g = Graph()
             g.parse(data=b, format=rdftype)
-            out = g.serialize(format='json-ld')
-            # AND THIS IS WHERE IT GETS CRAAAAAZEEEE...
-            # aka rdflib doesn't do framing so we re-re-parse it
-            j2 = json.loads(out)
-            j2 = {"@context": self.default_context, "@graph": j2}
-            framed = frame(j2, self.annoframe)
-            out = compact(framed, self.default_context)
-            # recursively clean blank node ids
-            out = self._clean_bnode_ids(out)
-            return out
-
-    def _handle_ld_json(self):
-        b = request._get_body_string()
-        if request.headers.get('Content-Type', '').strip().startswith("application/ld+json"):
-            # put the json into request.json, like application/json does automatically
-            # Except it doesn't seem to work :(
-            if b:
-                request._json = json.loads(b)
-            else:
-                request._json = request.json
-        elif b:
+            return self._frame_graph(g)
+
+    def _frame_graph(self, g):
+        load_rdf()
+        out = g.serialize(format='json-ld')
+        # AND THIS IS WHERE IT GETS CRAAAAAZEEEE...
+        # aka rdflib doesn't do framing so we re-re-parse it
+        j2 = json.loads(out)
+        j2 = {"@context": self.default_context, "@graph": j2}
+        framed = jsonld.frame(j2, self.annoframe)
+        out = jsonld.compact(framed, self.default_context)
+        # recursively clean blank node ids
+        out = self._clean_bnode_ids(out)
+        return out
+
+    def _check_body_size(self):
+        # Refuse bodies that say they're too big before reading any of them
+        if request.content_length > self.max_body_size:
+            abort(413, "Request body is over {0} bytes".format(self.max_body_size))
+
+    def _read_body(self):
+        # Read the body once, straight from wsgi.input rather than via
+        # Bottle's in memory or temporary file copy, up to max_body_size
+        clen = request.content_length
+        if request.chunked:
+            # De-chunked as it's read, giving up as soon as it's too big,
+            # rather than letting request.body spool all of it first
+            parts = []
+            size = 0
+            for part in request._iter_chunked(request.environ['wsgi.input'].read, request.MEMFILE_MAX):
+                size += len(part)
+                if size > self.max_body_size:
+                    abort(413, "Request body is over {0} bytes".format(self.max_body_size))
+                parts.append(part)
+            return "".join(parts)
+        elif clen >= 0:
+            b = request.environ['wsgi.input'].read(clen)
+        else:
+            # Neither a length nor chunked, so there's no body
+            return ""
+        if len(b) > self.max_body_size:
+            abort(413, "Request body is over {0} bytes".format(self.max_body_size))
+        return b
+
+    def _request_json(self):
+        # The body as JSON, converting from RDF if need be. Only parsed when
+        # a handler asks for it, and only once. None if there's no body.
+        if 'mango.json' in request.environ:
+            return request.environ['mango.json']
+        b = self._read_body()
+        ct = request.headers.get('Content-Type', '').split(';')[0].strip()
+        js = None
+        if b and (ct in patch_formats or ct in ['application/ld+json', 'application/json']):
             try:
-                j = self._rdf_to_jsonld(b)
-                if j:
-                    request._json = j
-            except:
-                raise
+                js = json.loads(b)
+            except ValueError, e:
+                abort(400, "JSON is not well formed: {0}".format(e))
+        elif b and self.rdflib_format_map.has_key(ct):
+            try:
+                js = self._rdf_to_jsonld(b, ct)
+            except Exception, e:
+                abort(400, "Could not read {0}: {1}".format(ct, e))
+        request.environ['mango.json'] = js
+        return js
 
 
     def _fix_json(self, js={}, via=False):
         # Validate / Patch JSON
         if not js:
-            try:    
-                js = request._json
-                if not js:
-                    abort(400, "Empty JSON")
-            except Exception, e:
-                abort(400, "JSON is not well formed: {0}".format(e))
+            js = self._request_json()
+            if not js:
+                abort(400, "Empty JSON")
         if js.has_key('_id'):
             del js['_id']
         if js.has_key('id'):
@@ -295,7 +411,7 @@ class MangoServer(object):
         for tgt in tgts:
             if type(tgt) != dict:
                 tgt = {'id': tgt}
-            if tgt['id'].startswith(self.url_host):
+            if tgt.get('id', '').startswith(self.url_host):
                 # XXX Fetch target resource
                 # and copy properties
                 pass                
@@ -344,10 +460,11 @@ class MangoServer(object):
 
     def _jsonify(self, what, uri):
         what['id'] = uri
-        try:
-            del what['_id']
-        except:
-            pass            
+        for k in ['_id', '_etag']:
+            try:
+                del what[k]
+            except:
+                pass            
         if self.compact_json:
             me = MongoEncoder(sort_keys=self.sort_keys, separators=(',',':'))
         if self.human_sort_keys:
@@ -396,10 +513,57 @@ class MangoServer(object):
             prefs.append((main, dict(params)))       
         return prefs
 
-    def _conneg(self, data, uri):
+    def _new_etag(self):
+        # Minted on every write, and stored with the document as '_etag' so
+        # that If-Match can be checked inside the write itself
+        return uuid.uuid4().hex
+
+    def _current_etag(self, data, uri):
+        # The stored ETag of data (removing it), or for documents written
+        # before ETags were stored, the hash of the JSON
+        token = data.pop('_etag', None)
+        if token:
+            return token
+        return self._hash(self._jsonify(data, uri))
+
+    def _hash(self, value):
+        h = hashlib.md5()
+        h.update(value)
+        return h.hexdigest()
+
+    def _parse_fields(self):
+        # ?fields=a,b,c selects top level properties (id is always included)
+        value = request.query.get('fields', '')
+        if not value:
+            return None
+        fields = []
+        for f in value.split(','):
+            f = f.strip()
+            if not f or f[0] in '$_' or f.find('.') > -1:
+                abort(400, "Cannot select field: {0}".format(f))
+            if not f in fields:
+                fields.append(f)
+        fields.sort()
+        return fields
+
+    def _fields_variant(self, fields):
+        # Partial representations must never share an ETag with the full one
+        if fields:
+            return "fields=" + ",".join(fields)
+        return ""
+
+    def _include_query(self, include, fields):
+        if fields:
+            return "{0}&fields={1}".format(include, ",".join(fields))
+        return include
+
+    def _conneg(self, data, uri, variant=""):
         # Content Negotiate with client
         # We're on our way out the door ...
+        # variant distinguishes the ETag of partial representations
 
+        # Stored documents carry their ETag, computed ones get a hash
+        token = data.pop('_etag', None)
         out = None
         accept = request.headers.get('Accept', '')
         ct = self.json_content_type
@@ -425,6 +589,7 @@ class MangoServer(object):
                                 pass
                     break
             if format:
+                load_rdf()
                 g = Graph()
                 d2 = self._mk_rdflib_jsonld(data)
                 d2str = self._jsonify(d2, uri)
@@ -432,10 +597,10 @@ class MangoServer(object):
                 out = g.serialize(format=format)
 
         hashed = self._jsonify(data, uri)
-        h = hashlib.md5()
-        h.update(hashed)
-
-        response['ETag'] = h.hexdigest()
+        if token and not variant:
+            response['ETag'] = token
+        else:
+            response['ETag'] = self._hash(variant + (token or hashed))
         if ct == self.json_content_type:
             ct += ';profile="{0}"'.format(profile)
         response['content_type'] = ct
@@ -456,10 +621,41 @@ class MangoServer(object):
         else:
             response.headers['link'] = l
 
-    def update_container_modified(self, coll):
-        coll.update_one({'_id': self._container_desc_id}, {'$set': {'modified': now()}})
+    def update_container_modified(self, container):
+        self.store.touch(container, now(), self._new_etag())
+
+    def _container_etag(self, metadata):
+        # From the container's version and everything else the response
+        # depends on, so it's known before any members are read. None for
+        # containers without a stored version, whose modified is too coarse
+        version = metadata.get('_etag')
+        if not version:
+            return None
+        return self._hash("\n".join([version, request.query_string,
+            request.headers.get('Accept', ''), request.headers.get('Prefer', '')]))
+
+    def _none_match(self, etag):
+        # Whether If-None-Match lists etag, or is *
+        tags = [x.strip() for x in request.headers.get('If-None-Match', '').split(',')]
+        tags = [x[2:] if x.startswith('W/') else x for x in tags]
+        tags = [x.strip('"') for x in tags]
+        return etag in tags or '*' in tags
+
+    def _container_version(self, metadata):
+        # Changes on every write to the container; modified only has
+        # second resolution, and is all there is for older containers
+        return metadata.get('_etag') or metadata.get('modified', metadata.get('created'))
+
+    def _container_links(self):
+        self.add_link_header('http://www.w3.org/ns/ldp#BasicContainer', {'rel':'type'})
+        self.add_link_header('http://www.w3.org/TR/annotation-protocol/', {'rel': 'http://www.w3.org/ns/ldp#constrainedBy'})
+        if request.query.get('page', ''):
+            self.add_link_header('http://www.w3.org/ns/oa#AnnotationPage', {'rel':'type'})
+        else:
+            self.add_link_header('http://www.w3.org/ns/oa#AnnotationCollection', {'rel':'type'})
 
-    def get_container_page(self, container, coll, metadata):
+    def get_container_page(self, container, metadata, listing=None):
+        # listing is (total, items) for the page, when already known
         uri = self._make_uri(container)
 
         include = request.query.get('include', self.server_prefers)
@@ -468,33 +664,21 @@ class MangoServer(object):
         page_size = getattr(self, "{0}_page_size".format(include))        
         offset = page * page_size
 
-        if include == 'description':
-            cursor = coll.find({'_id': {'$ne' : self._container_desc_id}})
-        else:
-            cursor = coll.find({'_id': {'$ne' : self._container_desc_id}}, {'_id':1})
-
-        totalItems = cursor.count()
-
-        included = []
-        for what in cursor.skip(offset).limit(page_size):
-            myid = what['_id']
-            if include == 'uri':
-                included.append(self._make_uri(container, self._unmake_id(myid)))
-            else:
-                out = self._fix_json(what)
-                out['id'] = self._make_uri(container, self._unmake_id(myid))           
-                try:
-                    del out['@context']
-                except:
-                    pass
-                included.append(out)
+        fields = self._parse_fields() if include == 'description' else None
+        if listing is None:
+            listing = self.store.items(container, self._make_uri(container, ""),
+                include, offset, page_size, fields=fields)
+        (totalItems, included) = listing
+        if include == 'uri':
+            included = [x['id'] for x in included]
+        # Keep the field selection in every link
+        include_q = self._include_query(include, fields)
 
         last_page = totalItems / page_size
-        first = "{0}?include={1}&page=0".format(uri, include)
-        last = "{0}?include={1}&page={2}".format(uri, include, last_page)
-        me = "{0}?include={1}&page={2}".format(uri, include, page)
-        curi = "{0}?include={1}".format(uri, include)
-        metadata = coll.find_one({"_id": self._container_desc_id})
+        first = "{0}?include={1}&page=0".format(uri, include_q)
+        last = "{0}?include={1}&page={2}".format(uri, include_q, last_page)
+        me = "{0}?include={1}&page={2}".format(uri, include_q, page)
+        curi = "{0}?include={1}".format(uri, include_q)
         modded = metadata.get('modified', metadata.get('created'))
 
         resp = {"@context": "http://www.w3.org/ns/anno.jsonld",
@@ -511,16 +695,17 @@ class MangoServer(object):
         if me != first:
             resp['partOf']['first'] = first
         if page != last_page:
-            resp['next'] = '{0}?include={1}&page={2}'.format(uri, include, page+1)
+            resp['next'] = '{0}?include={1}&page={2}'.format(uri, include_q, page+1)
             resp['partOf']['last'] = last
         if page:
-            resp['prev'] = '{0}?include={1}&page={2}'.format(uri, include, page-1)
-        return self._conneg(resp, me)
+            resp['prev'] = '{0}?include={1}&page={2}'.format(uri, include_q, page-1)
+        return self._conneg(resp, me, self._fields_variant(fields))
 
-    def get_container_projection(self, container, coll, metadata):
+    def get_container_projection(self, container, metadata):
         return self._conneg(resp, me)
 
-    def get_container_base(self, container, coll, metadata):
+    def get_container_base(self, container, metadata, listing=None):
+        # listing is (total, items) for the first page, when already known
 
         uri = self._make_uri(container)        
         prefer = request.headers.get('Prefer', '')
@@ -544,103 +729,95 @@ class MangoServer(object):
                         continue
                     response['Preference-Applied'] = "return=representation"
 
-        base = {'_id': {'$ne' : self._container_desc_id}}
-        if request.query.get('target', ''):
-            search = self._make_search(base)
-        else:
-            search = base
-        cursor = coll.find(search, {'_id':1})
-        totalItems = cursor.count()
-
+        target = self._target_term()
         page_size = getattr(self, "{0}_page_size".format(include))        
-        me = "{0}?include={1}".format(uri, include)
+        fields = self._parse_fields() if include == 'description' else None
+        include_q = self._include_query(include, fields)
+        me = "{0}?include={1}".format(uri, include_q)
+        # Count and first page come back from the same aggregation
+        limit = 0 if minimal else page_size
+        if listing is None:
+            listing = self.store.items(container, self._make_uri(container, ""),
+                include, 0, limit, target, fields=fields)
+        (totalItems, included) = listing
 
         resp = {"@context": ["http://www.w3.org/ns/anno.jsonld",
                 "http://www.w3c.org/ns/ldp.jsonld"],
                 "id": me,            
                 "total" : totalItems} 
-        resp.update(metadata)
+        resp.update(dict([(k, v) for (k, v) in metadata.items() if not k.startswith('_')]))
         response.headers['Content-Location'] = me
 
-        if include == 'description':
-            # redo the search to remove just _id filter
-            cursor = coll.find(search)
-
         last = totalItems/page_size;
-        firstUri = "{0}?include={1}&page=0".format(uri, include)
-        lastUri = "{0}?include={1}&page={2}".format(uri, include, last)
+        firstUri = "{0}?include={1}&page=0".format(uri, include_q)
+        lastUri = "{0}?include={1}&page={2}".format(uri, include_q, last)
 
         if not minimal:
-            included = []
-            for what in cursor.limit(page_size):
-                myid = what['_id']
-                out = self._fix_json(what)
-                out['id'] = self._make_uri(container, self._unmake_id(myid))           
-                try:
-                    # XXX This will kill any annotation level extensions
-                    del out['@context']
-                except:
-                    pass
-                included.append(out)
             resp['first'] = {"id": firstUri, "type": "AnnotationPage", 'startIndex': 0, 'items': included}
         else:
             resp['first'] = firstUri
         if lastUri != firstUri:
             resp['last'] = lastUri
 
-        return self._conneg(resp, me)
+        return self._conneg(resp, me, self._fields_variant(fields))
 
-    def _make_search(self, terms):
+    def _target_term(self):
         # Search for annotations where target is request.query['target']
-        # Can be anno.target, anno.target.id, anno.target.source, anno.target.source.id
-
-        qterm = request.query['target']
+        # The store matches anno.target, anno.target.id, anno.target.source, anno.target.source.id
+        qterm = request.query.get('target', '')
         if qterm.find("#") > -1:
             qterm = qterm[:qterm.find("#")]
-
-        qterm = {'$regex': '^%s' % qterm}
-        search = {'$or': [{'target': qterm}, {'target.id': qterm}, {'target.source': qterm}, {'target.source.id': qterm}]}
-        return {'$and': [search, terms]}
+        return qterm
     
 
     def get_container(self, container):
         # reroute to appropriate handler
-        coll = self._collection(container)
-        metadata = coll.find_one({"_id": self._container_desc_id})
+        metadata = self.store.get_metadata(container)
         if metadata == None:
             abort(404, "Unknown container")
 
-        self.add_link_header('http://www.w3.org/ns/ldp#BasicContainer', {'rel':'type'})
-        self.add_link_header('http://www.w3.org/TR/annotation-protocol/', {'rel': 'http://www.w3.org/ns/ldp#constrainedBy'})
+        if self.publish_dir:
+            published = self.serve_published(container, metadata, self._published_name())
+            if published is not None:
+                return published
+
+        self._container_links()
+
+        # Unchanged since the client last asked, without reading any members
+        etag = self._container_etag(metadata)
+        if etag and self._none_match(etag):
+            response['ETag'] = etag
+            response.status = 304
+            return ""
 
         if request.query.get('page', ''):
             # We're a page
-            self.add_link_header('http://www.w3.org/ns/oa#AnnotationPage', {'rel':'type'})
-            return self.get_container_page(container, coll, metadata)
+            out = self.get_container_page(container, metadata)
         else:
             # We're the full container
-            self.add_link_header('http://www.w3.org/ns/oa#AnnotationCollection', {'rel':'type'})
-            return self.get_container_base(container, coll, metadata)
+            out = self.get_container_base(container, metadata)
+        if etag:
+            response['ETag'] = etag
+        return out
 
     def put_container(self, container):
         # Grab the body and put it into magic __container_metadata__
         js = self._fix_json()
         js['modified'] = now()
-        coll = self._collection(container)
-        metadata = coll.find_one({"_id": self._container_desc_id})
+        js['_etag'] = self._new_etag()
+        metadata = self.store.get_metadata(container)
 
         if metadata == None:
             metadata = js
-            metadata["_id"] = self._container_desc_id
             try:
                 del metadata['id']
             except:
                 pass
-            current = coll.insert_one(metadata)
+            self.store.create_container(container, metadata)
             response.status = 201
         else:
             metadata.update(js)
-            coll.replace_one({"_id": self._container_desc_id}, js)
+            self.store.replace_metadata(container, js)
             current = metadata
             response.status = 200
 
@@ -648,49 +825,148 @@ class MangoServer(object):
         return self._conneg(js, uri)        
 
     def delete_container(self, container):
-        coll = self._collection(container)
-        coll.drop()
+        self.store.drop_container(container)
         response.status = 204
         return ""
 
+    def get_batch(self, container, wanted):
+        # Fetch many annotations by IRI or id with one query
+        # Returns an AnnotationPage of those found, with the IRIs that weren't
+        # and the ETag each item would have if fetched on its own
+        metadata = self.store.get_metadata(container)
+        if metadata == None:
+            abort(404, "Unknown container")
+        if type(wanted) == dict:
+            wanted = wanted.get('items', [])
+        if type(wanted) != list or not wanted:
+            abort(400, "Expected a list of annotation IRIs or ids")
+        if len(wanted) > self.batch_max_items:
+            abort(400, "At most {0} items can be fetched at once".format(self.batch_max_items))
+
+        base = self._make_uri(container)
+        idents = OrderedDict()
+        missing = []
+        for asked in wanted:
+            if type(asked) == dict:
+                asked = asked.get('id', '')
+            if not isinstance(asked, basestring):
+                continue
+            resource = asked[len(base):] if asked.startswith(base) else asked
+            if not resource or resource.find('/') > -1:
+                missing.append(asked)
+            else:
+                idents[self._make_id(container, resource)] = (asked, resource)
+
+        found = dict([(d['_id'], d) for d in self.store.get_many(container, idents.keys())])
+        items = []
+        etags = {}
+        for (ident, (asked, resource)) in idents.items():
+            data = found.get(ident)
+            if data is None:
+                missing.append(asked)
+                continue
+            uri = self._make_uri(container, resource)
+            etags[uri] = self._current_etag(data, uri)
+            data['id'] = uri
+            data.pop('_id', None)
+            try:
+                del data['@context']
+            except:
+                pass
+            items.append(data)
+
+        resp = {"@context": "http://www.w3.org/ns/anno.jsonld",
+                "type": "AnnotationPage",
+                "partOf": base,
+                "items": items,
+                "etags": etags}
+        if missing:
+            resp['missing'] = missing
+        return self._conneg(resp, self._make_uri(container, self._batch_id))
+
+    def get_stats(self, container):
+        # Member counts by motivation, creator, target canvas and day
+        # created, from counters kept up to date by the write handlers
+        metadata = self.store.get_metadata(container)
+        if metadata == None:
+            abort(404, "Unknown container")
+        stats = self.store.get_stats(container)
+        if stats is None or stats.pop('stale', False):
+            # Served as they are until recounted
+            self._rebuild_stats_later(container)
+        if stats is None:
+            raise HTTPError(503, "Stats are being counted, retry later", headers={'Retry-After': '10'})
+        stats['partOf'] = self._make_uri(container)
+        response['content_type'] = "application/json"
+        return self._jsonify(stats, self._make_uri(container, self._stats_id))
+
+    def _rebuild_stats_later(self, container):
+        # In the background, and only once at a time per container here;
+        # the store keeps other processes from rebuilding at the same time
+        with self._rebuilding_lock:
+            if container in self._rebuilding:
+                return
+            self._rebuilding.add(container)
+        def rebuild():
+            try:
+                self.store.rebuild_stats(container)
+            finally:
+                with self._rebuilding_lock:
+                    self._rebuilding.discard(container)
+        thread = threading.Thread(target=rebuild)
+        thread.daemon = True
+        thread.start()
+
     def get_resource(self, container, resource):
-        coll = self._collection(container)
-        data = coll.find_one({"_id": self._make_id(container, resource)})
+        if resource == self._batch_id:
+            return self.get_batch(container, request.query.getall('id'))
+        if resource == self._stats_id:
+            return self.get_stats(container)
+        if self.publish_dir and not request.query:
+            metadata = self.store.get_metadata(container)
+            if metadata != None:
+                published = self.serve_published(container, metadata, self._published_name(resource))
+                if published is not None:
+                    return published
+
+        fields = self._parse_fields()
+        data = self.store.get(container, self._make_id(container, resource), fields)
         if not data:
             abort(404)
 
         self.add_link_header('http://www.w3.org/ns/ldp#Resource', {'rel':'type'})
+        response.headers['Accept-Patch'] = ", ".join(sorted(patch_formats.keys()))
         uri = self._make_uri(container, resource)
-        return self._conneg(data, uri)
+        return self._conneg(data, uri, self._fields_variant(fields))
 
     def post_container(self, container):
-        coll = self._collection(container)
         js = self._fix_json(via=True)
         myid = self._make_id(container)
         uri = self._make_uri(container, myid)
         js = self.decorate_annotation(js, uri)
-        js["_id"] = uri
+        js["_id"] = myid
+        js["_etag"] = self._new_etag()
         response.headers['Location'] = uri
-        inserted = coll.insert_one(js)
-        self.update_container_modified(coll)
+        self.store.insert(container, js)
+        self.store.update_stats(container, stats_delta(None, js))
+        self.update_container_modified(container)
         response.status = 201
         return self._conneg(js, uri)
 
     def post_resource(self, container, resource):
+        if resource == self._batch_id:
+            return self.get_batch(container, self._request_json())
         abort(400, "Cannot POST to an individual resource, use PUT or POST to a container")
 
-    def check_if_match(self, coll, container, resource):
+    def check_if_match(self, container, resource):
         if 'if-match' in request.headers:
             check = request.headers['if-match']
-            data = coll.find_one({"_id": self._make_id(container, resource)})
+            data = self.store.get(container, self._make_id(container, resource))
             if not data:
                 abort(404)
 
             uri = self._make_uri(container, resource)
-            out = self._jsonify(data, uri)
-            h = hashlib.md5()
-            h.update(out)
-            current = h.hexdigest()           
+            current = self._current_etag(data, uri)
             if check != current:
                 # Collision
                 abort(412)
@@ -700,44 +976,369 @@ class MangoServer(object):
 
     def put_resource(self, container, resource):
         # Update individual Annotation
-        coll = self._collection(container)
         js = self._fix_json()
-        self.check_if_match(coll, container, resource) 
-        coll.replace_one({"_id": self._make_id(container, resource)}, js)
+        self.check_if_match(container, resource) 
+        js['_etag'] = self._new_etag()
+        old = self.store.replace(container, self._make_id(container, resource), js)
+        if old is not None:
+            self.store.update_stats(container, stats_delta(old, js))
         response.status = 202
         uri = self._make_uri(container, resource)
-        self.update_container_modified(coll)
+        self.update_container_modified(container)
         return self._conneg(js, uri)
 
     def patch_resource(self, container, resource):
-        coll = self._collection(container)
-        self.check_if_match(coll, container, resource) 
-        coll.update_one({"_id": self._make_id(container, resource)},
-                          {"$set": request._json})
+        # One atomic update, conditional on If-Match, returning the new document
+        # and counting the change to the stats from the old one
+        ct = request.headers.get('Content-Type', '').split(';')[0].strip()
+        body = self._request_json()
+        try:
+            patch = parse_patch(patch_formats.get(ct, 'set'), body)
+        except PatchError, e:
+            abort(400, str(e))
+
+        check = request.headers.get('if-match', None)
+        if not check and self.require_if_match:
+            abort(412, "No If-Match header for PATCH")
+        ident = self._make_id(container, resource)
+        uri = self._make_uri(container, resource)
+        res = self.store.patch(container, ident, patch, check, self._new_etag())
+
+        if res is None:
+            # Work out why, only on the way to failing
+            current = self.store.get(container, ident)
+            if not current:
+                abort(404)
+            legacy = not '_etag' in current
+            if check and self._current_etag(current, uri) != check:
+                abort(412)
+            if check and legacy:
+                # Written before ETags were stored, and the hash matches
+                res = self.store.patch(container, ident, patch, None, self._new_etag())
+            if res is None:
+                abort(409, "Patch could not be applied")
+
+        (old, data) = res
+        self.store.update_stats(container, stats_delta(old, data))
         response.status = 202
-        self.update_container_modified(coll)
-        return self.get_resource(container, resource)
+        self.update_container_modified(container)
+        self.add_link_header('http://www.w3.org/ns/ldp#Resource', {'rel':'type'})
+        return self._conneg(data, uri)
+
+    def delete_batch(self, container):
+        # Delete every annotation matching the query, in one go
+        # ?target= (as for searching), ?creator= and ?createdBefore=
+        # ?dryRun=true only counts what would be deleted
+        metadata = self.store.get_metadata(container)
+        if metadata == None:
+            abort(404, "Unknown container")
+        criteria = {'target': self._target_term(),
+                    'creator': request.query.get('creator', ''),
+                    'created_before': request.query.get('createdBefore', '')}
+        if not [x for x in criteria.values() if x]:
+            abort(400, "Bulk delete needs target, creator or createdBefore; DELETE the container to remove everything")
+        dry_run = request.query.get('dryRun', '') in ['true', '1']
+
+        count = self.store.delete_matching(container, dry_run=dry_run, **criteria)
+        if dry_run:
+            resp = {"matched": count}
+        else:
+            resp = {"removed": count}
+            if count:
+                self.store.invalidate_stats(container)
+                self.update_container_modified(container)
+        response['content_type'] = "application/json"
+        return self._jsonify(resp, request.url)
 
     def delete_resource(self, container, resource):
-        coll = self._collection(container)
+        if resource == self._batch_id:
+            return self.delete_batch(container)
         uri = self._make_uri(container, resource) 
-        self.check_if_match(coll, container, resource)
-        coll.delete_one({"_id": self._make_id(container, resource)})
-        self.update_container_modified(coll)
+        self.check_if_match(container, resource)
+        old = self.store.delete(container, self._make_id(container, resource))
+        if old is not None:
+            self.store.update_stats(container, stats_delta(old, None))
+        self.update_container_modified(container)
         response.status = 204
         return ""
 
     def head_container(self, container):
         val = self.get_container(container)
-        response.headers['Content-Length'] = len(val)
+        if hasattr(val, 'read'):
+            # Published file, which already set Content-Length
+            val.close()
+        else:
+            response.headers['Content-Length'] = len(val)
         return ""
 
     def head_resource(self, container, resource):
         val = self.get_resource(container, resource)
-        response.headers['Content-Length'] = len(val)
+        if hasattr(val, 'read'):
+            val.close()
+        else:
+            response.headers['Content-Length'] = len(val)
         return ""
 
+    def _quote(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return urllib.quote(value, safe='')
+
+    def _published_dir(self, container):
+        return os.path.join(self.publish_dir, self._quote(container) or '_')
+
+    def _published_name(self, resource=None):
+        # Name of the published file this request would get, or None if it
+        # needs rendering (a query, Prefer or Accept we don't publish)
+        if request.environ.get('mango.publishing') or request.headers.get('Prefer'):
+            return None
+        variant = 'jsonld'
+        accept = request.headers.get('Accept', '')
+        if accept:
+            for p in self._parse_accept(accept):
+                if self.rdflib_format_map.has_key(p[0]):
+                    variant = 'ttl' if p[0] == 'text/turtle' else None
+                    break
+                elif p[0] in ['application/json', 'application/ld+json']:
+                    if p[0] != self.json_content_type or p[1].get('profile', self.default_profile) != self.default_profile:
+                        variant = None
+                    break
+        if variant is None:
+            return None
+
+        if resource is not None:
+            return "items/{0}.{1}".format(self._quote(resource), variant)
+        if [k for k in request.query.keys() if not k in ['include', 'page']]:
+            return None
+        include = request.query.get('include', self.server_prefers)
+        if not include in ['description', 'uri']:
+            return None
+        page = request.query.get('page', '')
+        if not page:
+            return "base.{0}.{1}".format(include, variant)
+        if not page.isdigit():
+            return None
+        return "page.{0}.{1}.{2}".format(include, int(page), variant)
+
+    def _manifest(self, container):
+        # The container's published manifest, reread when it changes on disk
+        fn = os.path.join(self._published_dir(container), "manifest.json")
+        try:
+            mtime = os.stat(fn).st_mtime
+        except OSError:
+            return None
+        cached = self._manifests.get(container)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        fh = file(fn)
+        data = fh.read()
+        fh.close()
+        manifest = json.loads(data)
+        self._manifests[container] = (mtime, manifest)
+        return manifest
+
+    def serve_published(self, container, metadata, name):
+        # Serve a published file, if there is one and the container hasn't
+        # been modified since it was published. Returns None otherwise.
+        if not name:
+            return None
+        manifest = self._manifest(container)
+        if not manifest or manifest['version'] != self._container_version(metadata):
+            return None
+        entry = manifest['files'].get(name)
+        if not entry:
+            return None
+
+        for (k, v) in entry['headers'].items():
+            response.headers[k] = v
+        if self._none_match(entry['etag']):
+            response.status = 304
+            return ""
+        response.headers['Content-Length'] = str(entry['length'])
+        # A file object goes out through wsgi.file_wrapper, ie sendfile
+        return open(os.path.join(self._published_dir(container), name), 'rb')
+
+    def _environ(self, path, query="", accept=""):
+        # WSGI environ for a GET of path?query, as if from a client
+        environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': path,
+            'QUERY_STRING': query, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1', 'CONTENT_LENGTH': '0',
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(),
+            'wsgi.errors': sys.stderr, 'wsgi.multithread': False,
+            'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            'mango.publishing': True}
+        if accept:
+            environ['HTTP_ACCEPT'] = accept
+        return environ
+
+    def _render(self, path, query="", accept=""):
+        # Run a GET through the whole app as if from a client, returning
+        # (status, headers with lower case names, body)
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.append((int(status.split()[0]), dict([(k.lower(), v) for (k, v) in headers])))
+        body = "".join(self.app(self._environ(path, query, accept), start_response))
+        return (started[0][0], started[0][1], body)
+
+    def _write_published(self, where, fn, body, headers, files):
+        # Write one rendered variant into where, recording it in files
+        tmp = os.path.join(where, fn + ".tmp")
+        fh = open(tmp, 'wb')
+        fh.write(body)
+        fh.close()
+        os.rename(tmp, os.path.join(where, fn))
+        files[fn] = {'etag': headers.get('etag'), 'length': len(body),
+            'headers': dict([(k, headers[k.lower()]) for k in self.publish_headers if k.lower() in headers])}
+
+    def _publish_file(self, where, name, path, query, files):
+        # Render every variant of path?query into where, recording them in files
+        # Returns how many variants could be rendered
+        done = 0
+        for (variant, accept) in self.publish_variants.items():
+            (status, headers, body) = self._render(path, query, accept)
+            if status != 200:
+                continue
+            done += 1
+            self._write_published(where, "{0}.{1}".format(name, variant), body, headers, files)
+        return done
+
+    def _publish_listing(self, where, name, container, metadata, query, listing, files):
+        # As _publish_file, for the container or one of its pages with the
+        # members already read: the handlers build it from listing, without
+        # going back to the store
+        path = '/%s%s/' % (self.url_prefix, container)
+        done = 0
+        for (variant, accept) in self.publish_variants.items():
+            request.bind(self._environ(path, query, accept))
+            response.bind()
+            self._container_links()
+            try:
+                if request.query.get('page', ''):
+                    body = self.get_container_page(container, metadata, listing)
+                else:
+                    body = self.get_container_base(container, metadata, listing)
+            except Exception:
+                # As a failed render: this variant isn't published
+                continue
+            etag = self._container_etag(metadata)
+            if etag:
+                response['ETag'] = etag
+            headers = dict([(k.lower(), v) for (k, v) in response.headerlist])
+            done += 1
+            self._write_published(where, "{0}.{1}".format(name, variant), body, headers, files)
+        return done
+
+    def publish(self, container=None):
+        # Write every page and annotation of the container (or of all of
+        # them) in each of publish_variants under publish_dir, to be served
+        # as files until the container is next modified.
+        # Returns a list of (container, stats), stats None if up to date.
+        if not self.publish_dir:
+            raise ValueError("No publish_dir configured")
+        if not hasattr(self, 'app'):
+            self.get_bottle_app()
+        names = [container] if container else self.store.containers()
+        return [(name, self._publish_container(name)) for name in names]
+
+    def _publish_container(self, container):
+        metadata = self.store.get_metadata(container)
+        if metadata == None:
+            raise ValueError("Unknown container: %s" % container)
+        version = self._container_version(metadata)
+        where = self._published_dir(container)
+        if not os.path.exists(os.path.join(where, "items")):
+            os.makedirs(os.path.join(where, "items"))
+        old = self._manifest(container) or {'version': None, 'files': {}, 'items': {}}
+        if old['version'] == version and old['files']:
+            return None
+
+        stats = {'rendered': 0, 'kept': 0, 'removed': 0}
+        files = {}
+        path = '/%s%s/' % (self.url_prefix, container)
+        base = self._make_uri(container, "")
+
+        # Every page embeds the container's total and modified, so they all
+        # change along with it. They're built from a single pass over the
+        # members, with the total counted once up front
+        total = self.store.items(container, base, 'uri', 0, 0)[0]
+        includes = ['description', 'uri']
+        sizes = dict([(include, getattr(self, "{0}_page_size".format(include))) for include in includes])
+        pages = dict([(include, []) for include in includes])
+        numbers = dict([(include, 0) for include in includes])
+
+        # Annotations only need rendering again if their ETag changed
+        items = {}
+        changed = []
+        for doc in self.store.members(container):
+            ident = doc['_id']
+            etag = doc.get('_etag')
+            items[ident] = etag
+            name = "items/{0}".format(self._quote(ident))
+            kept = [v for v in self.publish_variants if "{0}.{1}".format(name, v) in old['files']]
+            if etag and old['items'].get(ident) == etag and len(kept) == len(self.publish_variants):
+                for v in kept:
+                    fn = "{0}.{1}".format(name, v)
+                    files[fn] = old['files'][fn]
+                stats['kept'] += 1
+            else:
+                changed.append(ident)
+
+            # As items() gives them
+            item = dict([(k, v) for (k, v) in doc.items() if not k in ['_id', '_etag', '@context']])
+            item['id'] = base + self._unmake_id(ident)
+            pages['description'].append(item)
+            pages['uri'].append({'id': item['id']})
+            for include in includes:
+                if len(pages[include]) == sizes[include]:
+                    stats['rendered'] += self._publish_page(where, container, metadata, include,
+                        numbers[include], (total, pages[include]), files)
+                    numbers[include] += 1
+                    pages[include] = []
+
+        # The rest, and any empty pages up to the last
+        for include in includes:
+            for page in range(numbers[include], total / sizes[include] + 1):
+                stats['rendered'] += self._publish_page(where, container, metadata, include,
+                    page, (total, pages[include]), files)
+                pages[include] = []
+
+        for ident in changed:
+            name = "items/{0}".format(self._quote(ident))
+            if isinstance(ident, unicode):
+                ident = ident.encode('utf-8')
+            if self._publish_file(where, name, path + ident, "", files):
+                stats['rendered'] += 1
+
+        for fn in old['files']:
+            if not fn in files:
+                try:
+                    os.remove(os.path.join(where, fn))
+                except OSError:
+                    pass
+                stats['removed'] += 1
+
+        manifest = {'version': version, 'files': files, 'items': items}
+        tmp = os.path.join(where, "manifest.json.tmp")
+        fh = open(tmp, 'w')
+        fh.write(json.dumps(manifest))
+        fh.close()
+        os.rename(tmp, os.path.join(where, "manifest.json"))
+        return stats
+
+    def _publish_page(self, where, container, metadata, include, page, listing, files):
+        # Publish a page of the container, and the container itself along
+        # with its first page. Returns how many files were rendered
+        done = 0
+        if not page and self._publish_listing(where, "base.{0}".format(include), container,
+                metadata, "include=" + include, listing, files):
+            done += 1
+        if self._publish_listing(where, "page.{0}.{1}".format(include, page), container,
+                metadata, "include={0}&page={1}".format(include, page), listing, files):
+            done += 1
+        return done
+
     def dispatch_views(self):
+        self.app.route('/' + self._metrics_id, ['GET'], self.get_metrics)
         methods = ["get", "head", "post", "put", "patch", "delete", "options"]
         for m in methods:
             self.app.route('/%s<container:re:.*>/' % self.url_prefix,
@@ -745,11 +1346,50 @@ class MangoServer(object):
             self.app.route('/%s<container:re:.*>/<resource>' % self.url_prefix,
                 [m], getattr(self, "%s_resource" % m, self.not_implemented))
 
+    def _request_class(self):
+        # "rdf" if the request parses or serializes RDF, otherwise "json"
+        ct = request.headers.get('Content-Type', '').split(';')[0].strip()
+        if self.rdflib_format_map.has_key(ct):
+            return 'rdf'
+        accept = request.headers.get('Accept', '')
+        if accept:
+            for p in self._parse_accept(accept):
+                if self.rdflib_format_map.has_key(p[0]):
+                    return 'rdf'
+                elif p[0] in ['application/json', 'application/ld+json']:
+                    break
+        return 'json'
+
+    def _admit(self):
+        # Shed the request with a 503 if it's over any of the limits
+        if not self.admission.enabled() or request.method == 'OPTIONS' \
+                or request.environ.get('mango.publishing') \
+                or request.path == '/' + self._metrics_id:
+            return
+        container = request.path[len(self.url_prefix) + 1:].rsplit('/', 1)[0]
+        client = request.environ.get('REMOTE_ADDR', '')
+        (held, shed) = self.admission.admit(container, client, self._request_class())
+        if shed:
+            (reason, retry) = shed
+            raise HTTPError(503, "Over %s, retry later" % reason, headers={'Retry-After': str(retry)})
+        request.environ['mango.admitted'] = held
+
+    def get_metrics(self):
+        response['content_type'] = "application/json"
+        return self._jsonify(self.admission.metrics(), request.url)
+
     def before_request(self):
-        # Process incoming application/ld+json as application/json
-        self._handle_ld_json()
+        # Admit the request before doing any work for it. Bodies are only
+        # read by the handlers that want them, see _request_json
+        if request.method in ['POST', 'PUT', 'PATCH']:
+            self._check_body_size()
+        self._admit()
 
     def after_request(self):
+        held = request.environ.pop('mango.admitted', None)
+        if held:
+            self.admission.release(held)
+
         # Add CORS and other static headers
         methods = 'PUT, PATCH, GET, POST, DELETE, OPTIONS, HEAD'
         hdrs = 'ETag, Vary, Accept, Prefer, Content-type, Link, Allow, Content-location, Location'
@@ -783,9 +1423,22 @@ class MangoServer(object):
             405: partial(self.error, message="Method Not Allowed"),
             403: partial(self.error, message="Forbidden"),
             412: partial(self.error, message="Precondition Failed"),
+            409: partial(self.error, message="Conflict"),
+            413: partial(self.error, message="Request Entity Too Large"),
+            503: partial(self.error, message="Service Unavailable"),
             400: partial(self.error, message="Client Error")
         }
 
+    def preload(self):
+        # Load rdflib and pyld, and their plugins and contexts, now rather
+        # than on the first RDF request, eg before a worker takes traffic
+        load_rdf()
+        g = Graph()
+        g.parse(data="<urn:x-mango:preload> a <http://www.w3.org/ns/oa#Annotation> .", format='turtle')
+        self._frame_graph(g)
+        for fmt in set(self.rdflib_format_map.values()):
+            g.serialize(format=fmt)
+
     def get_bottle_app(self):
         self.app = Bottle()
         self.dispatch_views()
@@ -816,6 +1469,40 @@ def main():
                        help="Number of spaces to indent json output")
     parser.add_option('--json-ld', dest="json_ld", default=True,
                        help="Should return json-ld media type instead of json?")
+    parser.add_option('--backend', dest="backend", default="mongo",
+                       help="Storage backend: 'mongo' or 'sqlite'")
+    parser.add_option('--sqlite-path', dest="sqlite_path", default="mango.sqlite",
+                       help="SQLite database file for the sqlite backend")
+    parser.add_option('--storage-layout', dest="storage_layout", default="collection",
+                       help="'collection' per container, or 'shared' for all containers in one collection")
+    parser.add_option('--migrate-to-shared', dest="migrate", action="store_true", default=False,
+                       help="Copy per-container collections into the shared layout and exit")
+    parser.add_option('--drop-migrated', dest="drop_migrated", action="store_true", default=False,
+                       help="With --migrate-to-shared, drop each collection once copied")
+    parser.add_option('--rebuild-stats', dest="rebuild_stats", action="store_true", default=False,
+                       help="Recount the stats of --container (or every container) and exit")
+    parser.add_option('--migrate-ids', dest="migrate_ids", action="store_true", default=False,
+                       help="Re-key annotations stored under their full URI to their id and exit")
+    parser.add_option('--id-strategy', dest="id_strategy", default="uuid7",
+                       help="New ids are 'uuid7' or 'ulid' (time ordered), or 'uuid4' (random)")
+    parser.add_option('--import-rdf', dest="import_rdf", default="",
+                       help="Import every oa:Annotation in an N-Triples or Turtle file and exit")
+    parser.add_option('--container', dest="container", default="",
+                       help="With --import-rdf, the (existing) container to import into")
+    parser.add_option('--rdf-format', dest="rdf_format", default=None,
+                       help="With --import-rdf, 'nt' or 'turtle' (default from the file extension)")
+    parser.add_option('--checkpoint', dest="checkpoint", default=None,
+                       help="With --import-rdf, checkpoint file to resume from (default FILE.import-checkpoint)")
+    parser.add_option('--publish-dir', dest="publish_dir", default=None,
+                       help="Directory of published containers to serve as static files")
+    parser.add_option('--publish', dest="publish", action="store_true", default=False,
+                       help="Publish --container (or every container) into --publish-dir and exit")
+    parser.add_option('--admission', dest="admission", default=None,
+                       help="Admission limits as JSON, eg '{\"max_in_flight\": 32, \"client_rate\": 10}'")
+    parser.add_option('--max-body-size', dest="max_body_size", default=1048576, type=int,
+                       help="Largest request body accepted, in bytes")
+    parser.add_option('--preload', dest="preload", action="store_true", default=False,
+                       help="Load the RDF libraries at startup rather than on first use")
     parser.add_option('--debug', dest="debug", default=True)
 
     options, args = parser.parse_args()
@@ -839,17 +1526,74 @@ def main():
         indent_json=options.indent_json,
         url_host = "http://%s:%s" % (host, port),
         url_prefix=options.url_prefix,
-        json_ld=jsonld
+        json_ld=jsonld,
+        storage_layout=options.storage_layout,
+        backend=options.backend,
+        sqlite_path=options.sqlite_path,
+        publish_dir=options.publish_dir,
+        admission=json.loads(options.admission) if options.admission else None,
+        id_strategy=options.id_strategy,
+        max_body_size=options.max_body_size
     )
 
+    if options.publish:
+        for (name, stats) in mr.publish(options.container or None):
+            if stats is None:
+                print "%s: up to date" % name
+            else:
+                print "%s: %s rendered, %s unchanged, %s removed" % (name,
+                    stats['rendered'], stats['kept'], stats['removed'])
+        return
+
+    if options.import_rdf:
+        import sys
+        from mangoimport import import_rdf
+        def progress(msg):
+            sys.stderr.write(msg + "\n")
+        state = import_rdf(mr, options.container, options.import_rdf, format=options.rdf_format,
+            checkpoint=options.checkpoint, progress=progress)
+        print "Imported %(imported)s annotations (%(existing)s already present, %(failed)s failed)" % state
+        return
+
+    if options.rebuild_stats:
+        for name in ([options.container] if options.container else mr.store.containers()):
+            stats = mr.store.rebuild_stats(name)
+            if stats is None:
+                print "%s: not rebuilt, it is being rebuilt or written to, try again" % name
+            else:
+                print "%s: %s annotations" % (name, stats['total'])
+        return
+
+    if options.migrate_ids:
+        for name in mr.store.containers():
+            (count, collisions) = mr.store.migrate_ids(name)
+            if count:
+                # Member ids are in every page, so the container's ETags change
+                mr.update_container_modified(name)
+            print "Re-keyed %s: %s annotations" % (name, count)
+            for ident in collisions:
+                print "  Left under %s: id already taken" % ident
+        return
+
+    if options.migrate:
+        for (name, count) in mr.store.migrate_to_shared(drop=options.drop_migrated):
+            print "Migrated %s: %s annotations" % (name, count)
+        return
+
+    if options.preload:
+        mr.preload()
     run(host=host, port=port, app=mr.get_bottle_app(), debug=debug)
 
 def apache():
-    fh = file('config.json')
+    # MANGO_CONFIG, or config.json next to this file
+    fh = file(os.environ.get('MANGO_CONFIG', os.path.join(here, 'config.json')))
     data = fh.read()
     fh.close()
     conf = json.loads(data)
+    preload = conf.pop('preload', False)
     ms = MangoServer(**conf)
+    if preload:
+        ms.preload()
     return ms.get_bottle_app()
 
 if __name__ == "__main__":
@@ -0,0 +1,1385 @@
+
+# Storage backends for MangoServer
+# The handlers only talk to a Store, never to Mongo or SQLite directly.
+# Documents are passed around as dicts with the resource id in '_id',
+# container metadata as a dict without one.
+
+import re
+import json
+import copy
+import datetime
+import sqlite3
+import threading
+
+# Requires pymongo 3.x, and MongoDB 3.4+ for $facet
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError
+
+
+class Store(object):
+    """Interface for annotation storage, one method per storage operation."""
+
+    def get_metadata(self, container):
+        """Container metadata, or None if there is no such container."""
+        raise NotImplementedError()
+
+    def containers(self):
+        """Names of all the containers."""
+        raise NotImplementedError()
+
+    def create_container(self, container, metadata):
+        raise NotImplementedError()
+
+    def replace_metadata(self, container, metadata):
+        raise NotImplementedError()
+
+    def touch(self, container, modified, etag=None):
+        """Set the container's modified time, and its version as '_etag'."""
+        raise NotImplementedError()
+
+    def drop_container(self, container):
+        raise NotImplementedError()
+
+    def exists(self, container, ident):
+        raise NotImplementedError()
+
+    def get(self, container, ident, fields=None):
+        """The stored document, or None.
+
+        fields limits the document to those top level properties, plus
+        '@context' so that it is still JSON-LD.
+        """
+        raise NotImplementedError()
+
+    def get_many(self, container, idents):
+        """The stored documents for those of idents that exist, in any order."""
+        raise NotImplementedError()
+
+    def insert(self, container, doc):
+        raise NotImplementedError()
+
+    def insert_many(self, container, docs):
+        """Insert a batch of documents, skipping any whose id is already taken.
+
+        Returns how many were inserted.
+        """
+        raise NotImplementedError()
+
+    def replace(self, container, ident, doc):
+        """Replace the document, returning the one it replaced, or None."""
+        raise NotImplementedError()
+
+    def delete(self, container, ident):
+        """Delete the document, returning it, or None if there was none."""
+        raise NotImplementedError()
+
+    def patch(self, container, ident, patch, etag=None, new_etag=None):
+        """Atomically apply a patch from parse_patch, returning (old, new) documents.
+
+        If etag is given the stored '_etag' must match it. new_etag is
+        stored as the document's '_etag'. Returns None if there was no
+        such document, the etag didn't match or the patch could not be
+        applied.
+        """
+        raise NotImplementedError()
+
+    def delete_matching(self, container, dry_run=False, target=None, creator=None, created_before=None):
+        """Delete every member matching all of the given criteria, returning how many.
+
+        target matches a target IRI exactly, or with any #fragment (not as
+        a prefix, as for searching), creator matches creator or creator.id,
+        created_before is compared to created as a string. With dry_run,
+        only count them.
+        """
+        raise NotImplementedError()
+
+    def members(self, container):
+        """Every member's stored document, in the order items() pages them."""
+        raise NotImplementedError()
+
+    def migrate_ids(self, container):
+        """Re-key members stored under their full URI to just their id.
+
+        Returns (how many were re-keyed, the old ids of any left as they
+        were because their new id is taken by a different document).
+        """
+        raise NotImplementedError()
+
+    def get_stats(self, container):
+        """The container's stats counters, or None if there are none yet.
+
+        {'total': n, dimension: {key: n}} for each of stat_dimensions, and
+        'stale': True if they need rebuilding.
+        """
+        raise NotImplementedError()
+
+    def update_stats(self, container, delta):
+        """Add a delta from stats_delta to the counters, if there are any."""
+        raise NotImplementedError()
+
+    def invalidate_stats(self, container):
+        """Mark the counters stale, after changes too broad to count."""
+        raise NotImplementedError()
+
+    def rebuild_stats(self, container):
+        """Recount the stats from the members, store and return them.
+
+        Returns None if another rebuild of the container is running, or
+        the recount couldn't be stored consistently.
+        """
+        raise NotImplementedError()
+
+    def items(self, container, base, include, offset, limit, target=None, fields=None):
+        """(total, items) for one page of the container's members.
+
+        Items are ready to encode: 'id' is base plus the resource id and
+        there is no '_id' or '@context'. include 'uri' gives items with
+        only an 'id'. A limit of 0 only counts. target restricts to
+        members with a target starting with that IRI, fields limits
+        descriptions to those top level properties.
+        """
+        raise NotImplementedError()
+
+
+def unmake_id(value):
+    if value.startswith('anno_'):
+        return value[5:]
+    else:
+        return value
+
+def select_fields(doc, fields):
+    # Top level projection, for stores that can't do it themselves
+    new = {}
+    for f in fields:
+        if f in doc:
+            new[f] = doc[f]
+    for f in ['_id', '_etag', '@context']:
+        if f in doc:
+            new[f] = doc[f]
+    return new
+
+class PatchError(ValueError):
+    # The patch document itself is malformed
+    pass
+
+class PatchFailed(Exception):
+    # The patch can't be applied to this document
+    pass
+
+class NotCompilable(Exception):
+    # The patch can't be expressed as a single Mongo update
+    pass
+
+patch_formats = {
+    'application/merge-patch+json': 'merge',
+    'application/json-patch+json': 'json-patch'
+}
+
+def _check_key(key):
+    # Top level properties that a patch may not touch
+    if not isinstance(key, basestring) or key.startswith('_') or key == 'id':
+        raise PatchError("Cannot patch property: {0}".format(key))
+
+def _pointer(value):
+    # JSON Pointer to a list of tokens
+    if not isinstance(value, basestring) or not value.startswith('/'):
+        raise PatchError("Invalid path: {0}".format(value))
+    tokens = [x.replace('~1', '/').replace('~0', '~') for x in value[1:].split('/')]
+    _check_key(tokens[0])
+    return tokens
+
+def parse_patch(kind, body):
+    # Validate a patch body, returning (kind, patch) for Store.patch
+    # kind is 'set' (plain JSON, top level properties are replaced), 'merge'
+    # (RFC 7396 JSON Merge Patch) or 'json-patch' (RFC 6902 JSON Patch)
+    if kind in ['set', 'merge']:
+        if type(body) != dict or not body:
+            raise PatchError("Patch must be a non-empty JSON object")
+        body = dict(body)
+        body.pop('id', None)
+        for k in body.keys():
+            _check_key(k)
+        return (kind, body)
+    elif kind == 'json-patch':
+        if type(body) != list or not body:
+            raise PatchError("JSON Patch must be a non-empty array of operations")
+        ops = []
+        for op in body:
+            if type(op) != dict or not op.get('op') in ['add', 'remove', 'replace', 'move', 'copy', 'test']:
+                raise PatchError("Invalid operation: {0}".format(op))
+            new = {'op': op['op'], 'path': _pointer(op.get('path'))}
+            if op['op'] in ['add', 'replace', 'test']:
+                if not 'value' in op:
+                    raise PatchError("Operation needs a value: {0}".format(op))
+                new['value'] = op['value']
+            elif op['op'] in ['move', 'copy']:
+                new['from'] = _pointer(op.get('from'))
+            ops.append(new)
+        return (kind, ops)
+    raise PatchError("Unknown patch format: {0}".format(kind))
+
+def _plain(tokens):
+    for t in tokens:
+        if not t or t.startswith('$') or t.find('.') > -1:
+            raise NotCompilable()
+    return ".".join(tokens)
+
+def _overlaps(a, b):
+    return a == b or a.startswith(b + '.') or b.startswith(a + '.')
+
+def _merge_sets(patch, prefix, sets, unsets):
+    for (k, v) in patch.items():
+        path = prefix + [k]
+        if prefix and (v is None or k.isdigit()):
+            # RFC 7396 makes {} of a missing or non-object parent, where
+            # $unset does nothing, and Mongo reads a number as an index
+            # into an array where the patch replaces the array
+            raise NotCompilable()
+        elif v is None:
+            unsets.append(_plain(path))
+        elif type(v) == dict and v:
+            _merge_sets(v, path, sets, unsets)
+        elif type(v) == dict:
+            # {} means "make sure this is an object", which needs the document
+            raise NotCompilable()
+        else:
+            sets.append((_plain(path), v))
+
+def compile_patch(kind, patch):
+    # Translate a parsed patch into (conditions, update) for a single
+    # find_one_and_update. conditions are extra filter clauses that must hold
+    # for the patch to apply (existence of removed or replaced paths).
+    # Raises NotCompilable when only applying the patch to the document
+    # itself will do.
+    conds = []
+    update = {}
+    if kind == 'set':
+        update['$set'] = dict([(_plain([k]), v) for (k, v) in patch.items()])
+        return (conds, update)
+    elif kind == 'merge':
+        sets = []
+        unsets = []
+        _merge_sets(patch, [], sets, unsets)
+        paths = [x[0] for x in sets] + unsets
+        for x in range(len(paths)):
+            for y in range(x+1, len(paths)):
+                if _overlaps(paths[x], paths[y]):
+                    raise NotCompilable()
+        if sets:
+            update['$set'] = dict(sets)
+        if unsets:
+            update['$unset'] = dict([(u, "") for u in unsets])
+        return (conds, update)
+
+    touched = []
+    for op in patch:
+        tokens = op['path']
+        path = _plain(tokens)
+        last = tokens[-1]
+        parent = _plain(tokens[:-1]) if len(tokens) > 1 else ""
+        if op['op'] == 'test':
+            # Mongo equality isn't JSON equality: {path: value} also matches
+            # an array that contains value
+            raise NotCompilable()
+        elif op['op'] == 'add' and parent and last == '-':
+            # Onto the end of an array
+            update.setdefault('$push', {})[parent] = {'$each': [op['value']]}
+            conds.append({parent: {'$exists': True}})
+            path = parent
+        elif op['op'] == 'add' and parent and last.isdigit():
+            # $position appends when the array is too short, where the
+            # patch has to fail
+            raise NotCompilable()
+        elif op['op'] == 'add':
+            update.setdefault('$set', {})[path] = op['value']
+            if parent:
+                conds.append({parent: {'$exists': True}})
+        elif op['op'] == 'replace' and not parent:
+            update.setdefault('$set', {})[path] = op['value']
+            conds.append({path: {'$exists': True}})
+        elif op['op'] == 'remove' and not parent:
+            update.setdefault('$unset', {})[path] = ""
+            conds.append({path: {'$exists': True}})
+        else:
+            # Below the top level $exists also matches through an array,
+            # where $unset does nothing. And move and copy
+            raise NotCompilable()
+        if [t for t in touched if _overlaps(t, path)]:
+            raise NotCompilable()
+        touched.append(path)
+    return (conds, update)
+
+def _merge(target, patch):
+    if type(target) != dict:
+        target = {}
+    for (k, v) in patch.items():
+        if v is None:
+            target.pop(k, None)
+        elif type(v) == dict:
+            target[k] = _merge(target.get(k), v)
+        else:
+            target[k] = v
+    return target
+
+def _resolve(doc, tokens):
+    # The container holding the last token, and that token as a key or index
+    where = doc
+    for t in tokens[:-1]:
+        try:
+            if type(where) == list:
+                where = where[int(t)]
+            else:
+                where = where[t]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise PatchFailed("No such path: /{0}".format("/".join(tokens)))
+    key = tokens[-1]
+    if type(where) == list:
+        if key == '-':
+            key = len(where)
+        else:
+            try:
+                key = int(key)
+            except ValueError:
+                raise PatchFailed("Not an array index: {0}".format(key))
+    elif type(where) != dict:
+        raise PatchFailed("No such path: /{0}".format("/".join(tokens)))
+    return (where, key)
+
+def _get(doc, tokens):
+    (where, key) = _resolve(doc, tokens)
+    try:
+        return where[key]
+    except (KeyError, IndexError):
+        raise PatchFailed("No such path: /{0}".format("/".join(tokens)))
+
+def _add(doc, tokens, value):
+    (where, key) = _resolve(doc, tokens)
+    if type(where) == list:
+        if key > len(where):
+            raise PatchFailed("Index out of range: /{0}".format("/".join(tokens)))
+        where.insert(key, value)
+    else:
+        where[key] = value
+
+def _remove(doc, tokens):
+    value = _get(doc, tokens)
+    (where, key) = _resolve(doc, tokens)
+    del where[key]
+    return value
+
+def apply_patch(doc, kind, patch):
+    # Apply a parsed patch to a copy of doc, raising PatchFailed if it can't be
+    doc = copy.deepcopy(doc)
+    if kind == 'set':
+        doc.update(patch)
+        return doc
+    elif kind == 'merge':
+        return _merge(doc, patch)
+    for op in patch:
+        if op['op'] == 'add':
+            _add(doc, op['path'], op['value'])
+        elif op['op'] == 'remove':
+            _remove(doc, op['path'])
+        elif op['op'] == 'replace':
+            _remove(doc, op['path'])
+            _add(doc, op['path'], op['value'])
+        elif op['op'] == 'move':
+            _add(doc, op['path'], _remove(doc, op['from']))
+        elif op['op'] == 'copy':
+            _add(doc, op['path'], copy.deepcopy(_get(doc, op['from'])))
+        elif op['op'] == 'test':
+            if _get(doc, op['path']) != op['value']:
+                raise PatchFailed("Test failed: /{0}".format("/".join(op['path'])))
+    return doc
+
+def creator_matches(doc, creator, created_before):
+    # Python equivalent of the creator and created_before criteria
+    if created_before:
+        created = doc.get('created')
+        if not isinstance(created, basestring) or not created < created_before:
+            return False
+    if creator:
+        who = doc.get('creator', [])
+        if type(who) != list:
+            who = [who]
+        who = [x.get('id') if type(x) == dict else x for x in who]
+        if not creator in who:
+            return False
+    return True
+
+def target_iris(doc):
+    # The IRIs a target search can match: target, target.id,
+    # target.source and target.source.id
+    iris = []
+    tgts = doc.get('target', [])
+    if type(tgts) != list:
+        tgts = [tgts]
+    for tgt in tgts:
+        if type(tgt) != dict:
+            iris.append(tgt)
+            continue
+        if 'id' in tgt:
+            iris.append(tgt['id'])
+        src = tgt.get('source')
+        if type(src) == dict:
+            src = src.get('id')
+        if src:
+            iris.append(src)
+    return [x for x in iris if isinstance(x, basestring)]
+
+# Per container counts of members by each of these, see annotation_stats
+stat_dimensions = ['motivation', 'creator', 'canvas', 'day']
+
+def _as_list(value):
+    if type(value) != list:
+        return [value]
+    return value
+
+def annotation_stats(doc):
+    # {dimension: [keys]} that doc counts towards: motivations, creator ids,
+    # the resources targeted (without fragment, so a canvas rather than a
+    # region of it) and the day it was created
+    found = {}
+    found['motivation'] = _as_list(doc.get('motivation', []))
+    found['creator'] = [x.get('id') if type(x) == dict else x for x in _as_list(doc.get('creator', []))]
+    canvases = []
+    for tgt in _as_list(doc.get('target', [])):
+        if type(tgt) == dict:
+            src = tgt.get('source')
+            tgt = src.get('id') if type(src) == dict else (src or tgt.get('id'))
+        if isinstance(tgt, basestring):
+            canvases.append(tgt.split('#')[0])
+    found['canvas'] = canvases
+    created = doc.get('created')
+    found['day'] = [created[:10]] if isinstance(created, basestring) else []
+    for (dim, keys) in found.items():
+        found[dim] = sorted(set([k for k in keys if isinstance(k, basestring) and k]))
+    return found
+
+def stats_delta(old, new):
+    # {(dimension, key): change} for old being replaced by new, either of
+    # which can be None; the member count is ('total', '')
+    delta = {}
+    for (doc, n) in [(old, -1), (new, 1)]:
+        if doc is None:
+            continue
+        delta[('total', '')] = delta.get(('total', ''), 0) + n
+        for (dim, keys) in annotation_stats(doc).items():
+            for k in keys:
+                delta[(dim, k)] = delta.get((dim, k), 0) + n
+    return dict([(k, v) for (k, v) in delta.items() if v])
+
+def count_stats(docs):
+    # Stats for docs, counted in Python
+    stats = dict([(dim, {}) for dim in stat_dimensions])
+    stats['total'] = 0
+    for doc in docs:
+        for ((dim, k), n) in stats_delta(None, doc).items():
+            if dim == 'total':
+                stats['total'] += n
+            else:
+                stats[dim][k] = stats[dim].get(k, 0) + n
+    return stats
+
+def _stat_key(key):
+    # Mongo field names can't contain '.' or start with '$'
+    return key.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+def _unstat_key(key):
+    return key.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+
+class SharedContainer(object):
+    # One container of the "shared" storage layout, presenting the subset of
+    # pymongo's Collection API that the handlers use, so they can't tell the
+    # difference from a per-container collection.
+    # Annotations are stored with their container in '_container' and their
+    # id in '_aid' (with a unique compound index over both); the metadata
+    # document is stored in the containers collection with the container
+    # name as its _id.
+
+    def __init__(self, annos, containers, name, desc_id):
+        self.annos = annos
+        self.containers = containers
+        self.name = name
+        self.desc_id = desc_id
+
+    def _is_desc(self, filt):
+        return type(filt) == dict and filt.get('_id') == self.desc_id
+
+    def _rename(self, what):
+        if type(what) == dict:
+            new = {}
+            for (k,v) in what.items():
+                if k == '_id':
+                    k = '_aid'
+                new[k] = self._rename(v)
+            return new
+        elif type(what) == list:
+            return [self._rename(x) for x in what]
+        return what
+
+    def _scope(self, filt):
+        q = self._rename(filt or {})
+        q['_container'] = self.name
+        return q
+
+    def _to_store(self, doc, aid=None):
+        doc = dict(doc)
+        if '_id' in doc:
+            aid = doc.pop('_id')
+        doc['_aid'] = aid
+        doc['_container'] = self.name
+        return doc
+
+    def _from_store(self, doc):
+        if doc is None:
+            return None
+        doc.pop('_id', None)
+        doc.pop('_container', None)
+        if '_aid' in doc:
+            doc['_id'] = doc.pop('_aid')
+        return doc
+
+    def _projection(self, projection):
+        # Renamed, and always bringing back the id
+        projection = self._rename(projection)
+        if [v for v in projection.values() if v]:
+            projection['_aid'] = 1
+        return projection
+
+    def find_one(self, filt=None, *args, **kwargs):
+        if args and args[0] is not None and not self._is_desc(filt):
+            args = (self._projection(args[0]),) + args[1:]
+        if self._is_desc(filt):
+            doc = self.containers.find_one({'_id': self.name}, *args, **kwargs)
+            if doc is not None:
+                doc['_id'] = self.desc_id
+            return doc
+        return self._from_store(self.annos.find_one(self._scope(filt), *args, **kwargs))
+
+    def find(self, filt=None, projection=None, **kwargs):
+        if projection is not None:
+            projection = self._projection(projection)
+        for doc in self.annos.find(self._scope(filt), projection, **kwargs):
+            yield self._from_store(doc)
+
+    def aggregate(self, pipeline, **kwargs):
+        # Scope to the container first (folding in a leading $match so it
+        # can use the index), then make documents look like they would in
+        # their own collection for the rest of the pipeline
+        pipeline = list(pipeline)
+        match = {}
+        if pipeline and '$match' in pipeline[0]:
+            match = pipeline.pop(0)['$match']
+        pipeline = [{'$match': self._scope(match)},
+                    {'$addFields': {'_id': '$_aid'}},
+                    {'$project': {'_aid': 0, '_container': 0}}] + pipeline
+        return self.annos.aggregate(pipeline, **kwargs)
+
+    def insert_many(self, docs, **kwargs):
+        return self.annos.insert_many([self._to_store(d) for d in docs], **kwargs)
+
+    def insert_one(self, doc, **kwargs):
+        if doc.get('_id') == self.desc_id:
+            doc = dict(doc)
+            doc['_id'] = self.name
+            return self.containers.insert_one(doc, **kwargs)
+        return self.annos.insert_one(self._to_store(doc), **kwargs)
+
+    def replace_one(self, filt, replacement, **kwargs):
+        if self._is_desc(filt):
+            replacement = dict(replacement)
+            replacement.pop('_id', None)
+            return self.containers.replace_one({'_id': self.name}, replacement, **kwargs)
+        return self.annos.replace_one(self._scope(filt),
+            self._to_store(replacement, filt.get('_id')), **kwargs)
+
+    def update_one(self, filt, update, **kwargs):
+        if self._is_desc(filt):
+            return self.containers.update_one({'_id': self.name}, update, **kwargs)
+        return self.annos.update_one(self._scope(filt), update, **kwargs)
+
+    def find_one_and_update(self, filt, update, **kwargs):
+        return self._from_store(self.annos.find_one_and_update(self._scope(filt), update, **kwargs))
+
+    def find_one_and_replace(self, filt, replacement, **kwargs):
+        return self._from_store(self.annos.find_one_and_replace(self._scope(filt),
+            self._to_store(replacement, filt.get('_id')), **kwargs))
+
+    def find_one_and_delete(self, filt, **kwargs):
+        return self._from_store(self.annos.find_one_and_delete(self._scope(filt), **kwargs))
+
+    def delete_one(self, filt, **kwargs):
+        return self.annos.delete_one(self._scope(filt), **kwargs)
+
+    def delete_many(self, filt, **kwargs):
+        return self.annos.delete_many(self._scope(filt), **kwargs)
+
+    def count(self, filt=None, **kwargs):
+        return self.annos.count(self._scope(filt), **kwargs)
+
+    def drop(self):
+        self.annos.delete_many({'_container': self.name})
+        self.containers.delete_one({'_id': self.name})
+
+
+class MongoStore(Store):
+
+    def __init__(self, database="mango", host='localhost', port=27017,
+                 storage_layout="collection", desc_id="__container_metadata__"):
+        self.mongo_host = host
+        self.mongo_port = port
+        self.mongo_db = database
+        # Connected on first use, not at startup (or before a WSGI fork)
+        self._connection = None
+        self.desc_id = desc_id
+
+        # "collection" is one Mongo collection per container,
+        # "shared" is all containers in shared_annotations/shared_containers
+        if not storage_layout in ['collection', 'shared']:
+            raise ValueError("Unknown storage_layout: %s" % storage_layout)
+        self.storage_layout = storage_layout
+        self.shared_annotations = "__annotations__"
+        self.shared_containers = "__containers__"
+        self._shared_indexed = False
+        # Stats counters for every container, with the container as _id
+        self.stats_collection = "__stats__"
+
+    def _connect(self, database, host=None, port=None):
+        return MongoClient(host=host, port=port)[database]
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = self._connect(self.mongo_db, self.mongo_host, self.mongo_port)
+        return self._connection
+
+    def _collection(self, container):
+        if self.storage_layout == 'shared':
+            annos = self.connection[self.shared_annotations]
+            if not self._shared_indexed:
+                annos.create_index([('_container', 1), ('_aid', 1)], unique=True)
+                self._shared_indexed = True
+            return SharedContainer(annos, self.connection[self.shared_containers],
+                container, self.desc_id)
+
+        container = self.connection[container]
+        return container
+
+    def _target_search(self, target, exact=False):
+        # Search for annotations where target is target
+        # Can be anno.target, anno.target.id, anno.target.source, anno.target.source.id
+        # exact matches only target itself, or with a #fragment
+        if exact:
+            qterm = {'$regex': '^' + re.escape(target) + '(#|$)'}
+        else:
+            qterm = {'$regex': '^%s' % target}
+        return {'$or': [{'target': qterm}, {'target.id': qterm}, {'target.source': qterm}, {'target.source.id': qterm}]}
+
+    def _search(self, target=None, creator=None, created_before=None, exact=False):
+        # Members of the container matching all of the criteria given
+        clauses = [{'_id': {'$ne' : self.desc_id}}]
+        if target:
+            clauses.append(self._target_search(target, exact))
+        if creator:
+            clauses.append({'$or': [{'creator': creator}, {'creator.id': creator}]})
+        if created_before:
+            clauses.append({'created': {'$lt': created_before}})
+        if len(clauses) == 1:
+            return clauses[0]
+        return {'$and': clauses}
+
+    def _item_id_expr(self, base):
+        # Aggregation equivalent of base + unmake_id(_id)
+        return {'$concat': [base,
+            {'$cond': [{'$eq': [{'$substrCP': ['$_id', 0, 5]}, 'anno_']},
+                       {'$substrCP': ['$_id', 5, {'$strLenCP': '$_id'}]},
+                       '$_id']}]}
+
+    def get_metadata(self, container):
+        metadata = self._collection(container).find_one({"_id": self.desc_id})
+        if metadata is not None:
+            del metadata['_id']
+        return metadata
+
+    def containers(self):
+        if self.storage_layout == 'shared':
+            return [x['_id'] for x in self.connection[self.shared_containers].find({}, {'_id': 1})]
+        names = []
+        for name in self.connection.collection_names(include_system_collections=False):
+            if name in [self.shared_annotations, self.shared_containers, self.stats_collection]:
+                continue
+            if self.connection[name].find_one({"_id": self.desc_id}, {"_id": 1}):
+                names.append(name)
+        return names
+
+    def create_container(self, container, metadata):
+        metadata = dict(metadata)
+        metadata["_id"] = self.desc_id
+        self._collection(container).insert_one(metadata)
+        self.connection[self.stats_collection].replace_one({'_id': container},
+            {'total': 0, 'built': True, 'writes': 0}, upsert=True)
+
+    def replace_metadata(self, container, metadata):
+        self._collection(container).replace_one({"_id": self.desc_id}, metadata)
+
+    def touch(self, container, modified, etag=None):
+        self._collection(container).update_one({'_id': self.desc_id},
+            {'$set': {'modified': modified, '_etag': etag}})
+
+    def drop_container(self, container):
+        self._collection(container).drop()
+        self.connection[self.stats_collection].delete_one({'_id': container})
+
+    def exists(self, container, ident):
+        return self._collection(container).find_one({"_id": ident}, {"_id": 1}) is not None
+
+    def get(self, container, ident, fields=None):
+        projection = None
+        if fields:
+            projection = dict([(f, 1) for f in fields])
+            projection['_etag'] = 1
+            projection['@context'] = 1
+        return self._collection(container).find_one({"_id": ident}, projection)
+
+    def get_many(self, container, idents):
+        return list(self._collection(container).find({"_id": {"$in": list(idents)}}))
+
+    def insert(self, container, doc):
+        self._collection(container).insert_one(doc)
+
+    def insert_many(self, container, docs):
+        if not docs:
+            return 0
+        try:
+            return len(self._collection(container).insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError, e:
+            # Only duplicate keys are expected
+            errors = e.details.get('writeErrors', [])
+            if [x for x in errors if x.get('code') != 11000]:
+                raise
+            return e.details.get('nInserted', 0)
+
+    def replace(self, container, ident, doc):
+        return self._collection(container).find_one_and_replace({"_id": ident}, doc)
+
+    def delete(self, container, ident):
+        return self._collection(container).find_one_and_delete({"_id": ident})
+
+    def patch(self, container, ident, patch, etag=None, new_etag=None):
+        (kind, patch) = patch
+        coll = self._collection(container)
+        filt = [{'_id': ident}]
+        if etag:
+            filt.append({'_etag': etag})
+        # The old document, for the stats. Both ways of writing the patch
+        # only apply to the document still being this one
+        current = coll.find_one({'$and': filt})
+        if current is None:
+            return None
+        check = {'_id': ident}
+        if '_etag' in current:
+            check['_etag'] = current['_etag']
+        else:
+            check['_etag'] = {'$exists': False}
+        try:
+            (conds, update) = compile_patch(kind, patch)
+            update.setdefault('$set', {})['_etag'] = new_etag
+            new = coll.find_one_and_update({'$and': [check] + conds}, update,
+                return_document=ReturnDocument.AFTER)
+            if new is not None:
+                return (current, new)
+            # The patch doesn't apply, or the document just changed
+        except NotCompilable:
+            pass
+        except OperationFailure:
+            # eg setting a property inside something that isn't an object
+            pass
+
+        # Apply it ourselves, and only write it back if the document is
+        # still the one we read
+        try:
+            new = apply_patch(current, kind, patch)
+        except PatchFailed:
+            return None
+        new['_etag'] = new_etag
+        res = coll.replace_one(check, new)
+        if not res.matched_count:
+            return None
+        return (current, new)
+
+    def delete_matching(self, container, dry_run=False, target=None, creator=None, created_before=None):
+        coll = self._collection(container)
+        search = self._search(target, creator, created_before, exact=True)
+        if dry_run:
+            return coll.count(search)
+        return coll.delete_many(search).deleted_count
+
+    def members(self, container):
+        return self._collection(container).find(self._search())
+
+    def _stats_inc(self, delta):
+        # $inc for a {(dimension, key): n} delta
+        inc = {}
+        for ((dim, k), n) in delta.items():
+            inc[dim if dim == 'total' else "%s.%s" % (dim, _stat_key(k))] = n
+        return inc
+
+    def _stats(self, doc):
+        stats = {'total': doc.get('total', 0)}
+        for dim in stat_dimensions:
+            stats[dim] = dict([(_unstat_key(k), n) for (k, n) in doc.get(dim, {}).items() if n])
+        return stats
+
+    def get_stats(self, container):
+        doc = self.connection[self.stats_collection].find_one({'_id': container})
+        if doc is None or not doc.get('built'):
+            # Missing, or only the increments of writes since
+            return None
+        stats = self._stats(doc)
+        if doc.get('stale'):
+            stats['stale'] = True
+        return stats
+
+    def update_stats(self, container, delta):
+        inc = self._stats_inc(delta)
+        if inc:
+            # Upserted, so increments made while the stats are missing are
+            # kept. Every write is counted, so that rebuild_stats can tell
+            # if there were any while it was counting
+            inc['writes'] = 1
+            self.connection[self.stats_collection].update_one({'_id': container}, {'$inc': inc}, upsert=True)
+
+    def invalidate_stats(self, container):
+        # Still served until they're rebuilt
+        self.connection[self.stats_collection].update_one({'_id': container},
+            {'$set': {'stale': True}, '$inc': {'writes': 1}})
+
+    def _recount(self, container):
+        # One pass over the members: for each dimension, the distinct keys of
+        # each member, then how many members have each key
+        def facet(key, first=[]):
+            return first + [{'$project': {'k': key}},
+                {'$unwind': '$k'},
+                {'$match': {'k': {'$type': 'string', '$ne': ''}}},
+                {'$group': {'_id': {'a': '$_id', 'k': '$k'}}},
+                {'$group': {'_id': '$_id.k', 'n': {'$sum': 1}}}]
+        unwound = lambda field: [{'$project': {'k': field}}, {'$unwind': '$k'}]
+        string = lambda expr, value: {'$cond': [{'$eq': [{'$type': expr}, 'string']}, value, None]}
+        facets = {
+            'total': [{'$count': 'n'}],
+            'motivation': facet('$k', unwound('$motivation')),
+            'creator': facet({'$ifNull': ['$k.id', '$k']}, unwound('$creator')),
+            'canvas': facet(string('$k', {'$arrayElemAt': [{'$split': ['$k', '#']}, 0]}),
+                unwound('$target') + [{'$project': {'k': {'$ifNull': ['$k.source.id',
+                    {'$ifNull': ['$k.source', {'$ifNull': ['$k.id', '$k']}]}]}}}]),
+            'day': facet(string('$created', {'$substrCP': ['$created', 0, 10]}))
+        }
+        res = list(self._collection(container).aggregate([{'$match': self._search()}, {'$facet': facets}]))
+        res = res[0] if res else {}
+        doc = {'total': res['total'][0]['n'] if res.get('total') else 0}
+        for dim in stat_dimensions:
+            doc[dim] = dict([(_stat_key(x['_id']), x['n']) for x in res.get(dim, [])])
+        return doc
+
+    def rebuild_stats(self, container, attempts=3, lease=600):
+        # The counters carry on being served and incremented while the
+        # members are recounted, and the recount only replaces them if no
+        # write was counted in the meantime; otherwise it's tried again.
+        # Only one rebuild of a container runs at a time, holding a lease in
+        # its own document for at most lease seconds.
+        coll = self.connection[self.stats_collection]
+        key = {'rebuild': container}
+        now = datetime.datetime.utcnow()
+        until = now + datetime.timedelta(seconds=lease)
+        try:
+            coll.update_one({'_id': key, 'until': {'$lt': now}}, {'$set': {'until': until}}, upsert=True)
+        except DuplicateKeyError:
+            # Held by a rebuild that hasn't expired
+            return None
+        try:
+            for x in range(attempts):
+                writes = (coll.find_one({'_id': container}, {'writes': 1}) or {}).get('writes')
+                doc = self._recount(container)
+                doc.update({'built': True, 'writes': writes or 0})
+                try:
+                    res = coll.replace_one({'_id': container, 'writes': writes}, doc, upsert=True)
+                except DuplicateKeyError:
+                    # Written to since, so upserting instead
+                    continue
+                if res.matched_count or res.upserted_id is not None:
+                    return self._stats(doc)
+            return None
+        finally:
+            coll.delete_one({'_id': key, 'until': until})
+
+    def migrate_ids(self, container, batch_size=1000):
+        # _id can't be changed, so insert under the new one and then delete
+        # the old, but only once the document under the new id is verified
+        # to be the copy. Re-running after an interruption finds the copies
+        # already there.
+        coll = self._collection(container)
+        count = 0
+        collisions = []
+        while True:
+            docs = list(coll.find({'_id': {'$regex': '/', '$nin': collisions}}, limit=batch_size))
+            if not docs:
+                break
+            copies = []
+            for d in docs:
+                copy = dict(d)
+                copy['_id'] = d['_id'].rsplit('/', 1)[1]
+                copies.append(copy)
+            self.insert_many(container, copies)
+            stored = dict([(d['_id'], d) for d in coll.find({'_id': {'$in': [c['_id'] for c in copies]}})])
+            moved = []
+            for (d, copy) in zip(docs, copies):
+                if stored.get(copy['_id']) == copy:
+                    moved.append(d['_id'])
+                else:
+                    collisions.append(d['_id'])
+            if moved:
+                coll.delete_many({'_id': {'$in': moved}})
+            count += len(moved)
+        return (count, collisions)
+
+    def _keys_pipeline(self, coll, search):
+        # Pipeline of just the ids of the members matching search, and the
+        # stages that swap each for its whole document, read by _id. The
+        # shared layout keys on the (_container, _aid) index instead, and
+        # reads the document back by the shared collection's own _id
+        if self.storage_layout == 'shared':
+            keys = [{'$match': coll._scope(search)},
+                    {'$project': {'_id': '$_aid', '_ref': '$_id'}}]
+            fetch = [{'$lookup': {'from': coll.annos.name, 'localField': '_ref',
+                                  'foreignField': '_id', 'as': '_doc'}},
+                     {'$unwind': '$_doc'},
+                     {'$replaceRoot': {'newRoot': '$_doc'}},
+                     {'$addFields': {'_id': '$_aid'}},
+                     {'$project': {'_aid': 0, '_container': 0}}]
+            return (coll.annos, keys, fetch)
+        keys = [{'$match': search}, {'$project': {'_id': 1}}]
+        fetch = [{'$lookup': {'from': coll.name, 'localField': '_id',
+                              'foreignField': '_id', 'as': '_doc'}},
+                 {'$unwind': '$_doc'},
+                 {'$replaceRoot': {'newRoot': '$_doc'}}]
+        return (coll, keys, fetch)
+
+    def items(self, container, base, include, offset, limit, target=None, fields=None):
+        # Count the members and build one page of them in a single
+        # aggregation, so the server only has to encode the result.
+        # $facet is only fed ids, so that only the page's documents are
+        # read in full
+        (coll, keys, fetch) = self._keys_pipeline(self._collection(container), self._search(target))
+        facets = {'total': [{'$count': 'n'}]}
+        if limit:
+            idexpr = self._item_id_expr(base)
+            if include == 'description' and fields:
+                # Unselected properties are never read out of the pipeline
+                proj = dict([(f, 1) for f in fields])
+                proj.pop('@context', None)
+                proj.update({'_id': 0, 'id': idexpr})
+                shape = [{'$project': proj}]
+            elif include == 'description':
+                shape = [{'$addFields': {'id': idexpr}},
+                         # XXX This will kill any annotation level extensions
+                         {'$project': {'_id': 0, '_etag': 0, '@context': 0}}]
+            else:
+                fetch = []
+                shape = [{'$project': {'_id': 0, 'id': idexpr}}]
+            facets['items'] = [{'$skip': offset}, {'$limit': limit}] + fetch + shape
+        res = list(coll.aggregate(keys + [{'$facet': facets}]))
+        if not res:
+            return (0, [])
+        res = res[0]
+        total = res['total'][0]['n'] if res['total'] else 0
+        return (total, res.get('items', []))
+
+    def migrate_to_shared(self, drop=False, batch_size=1000):
+        # Copy every per-container collection into the shared layout.
+        # Safe to re-run: documents are upserted on (container, id).
+        # Returns a list of (container, count) for what was copied.
+        from pymongo import ReplaceOne
+        layout = self.storage_layout
+        self.storage_layout = 'shared'
+        done = []
+        try:
+            skip = [self.shared_annotations, self.shared_containers]
+            for name in self.connection.collection_names(include_system_collections=False):
+                if name in skip:
+                    continue
+                src = self.connection[name]
+                metadata = src.find_one({"_id": self.desc_id})
+                if metadata is None:
+                    # Not a container
+                    continue
+                dest = self._collection(name)
+                dest.replace_one({"_id": self.desc_id}, metadata, upsert=True)
+
+                count = 0
+                ops = []
+                for doc in src.find({'_id': {'$ne': self.desc_id}}):
+                    doc = dest._to_store(doc)
+                    ops.append(ReplaceOne({'_container': name, '_aid': doc['_aid']}, doc, upsert=True))
+                    if len(ops) >= batch_size:
+                        dest.annos.bulk_write(ops, ordered=False)
+                        count += len(ops)
+                        ops = []
+                if ops:
+                    dest.annos.bulk_write(ops, ordered=False)
+                    count += len(ops)
+                if drop:
+                    src.drop()
+                done.append((name, count))
+        finally:
+            self.storage_layout = layout
+        return done
+
+
+class SQLiteStore(Store):
+    # Embedded single-node storage: documents are JSON text, with the
+    # container sequence (insertion order, for paging) and target IRIs
+    # held in indexed columns.
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS containers (
+            name TEXT PRIMARY KEY,
+            metadata TEXT NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS annotations (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            container TEXT NOT NULL,
+            id TEXT NOT NULL,
+            doc TEXT NOT NULL,
+            UNIQUE (container, id))""",
+        "CREATE INDEX IF NOT EXISTS annotations_seq ON annotations (container, seq)",
+        """CREATE TABLE IF NOT EXISTS targets (
+            container TEXT NOT NULL,
+            id TEXT NOT NULL,
+            iri TEXT NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS targets_iri ON targets (container, iri)",
+        "CREATE INDEX IF NOT EXISTS targets_id ON targets (container, id)",
+        """CREATE TABLE IF NOT EXISTS stats (
+            container TEXT NOT NULL,
+            dim TEXT NOT NULL,
+            key TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (container, dim, key))"""
+    ]
+
+    def __init__(self, path="mango.sqlite"):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            for stmt in self.schema:
+                conn.execute(stmt)
+
+    def _conn(self):
+        # sqlite3 connections can't be shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _dump(self, doc):
+        return json.dumps(doc, separators=(',',':'))
+
+    def _set_targets(self, conn, container, ident, doc):
+        conn.execute("DELETE FROM targets WHERE container=? AND id=?", (container, ident))
+        conn.executemany("INSERT INTO targets (container, id, iri) VALUES (?,?,?)",
+            [(container, ident, iri) for iri in target_iris(doc)])
+
+    def get_metadata(self, container):
+        row = self._conn().execute("SELECT metadata FROM containers WHERE name=?",
+            (container,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def containers(self):
+        return [r[0] for r in self._conn().execute("SELECT name FROM containers ORDER BY name")]
+
+    def create_container(self, container, metadata):
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO containers (name, metadata) VALUES (?,?)",
+                (container, self._dump(metadata)))
+            conn.execute("INSERT OR REPLACE INTO stats (container, dim, key, n) VALUES (?,'total','',0)",
+                (container,))
+
+    def replace_metadata(self, container, metadata):
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE containers SET metadata=? WHERE name=?",
+                (self._dump(metadata), container))
+
+    def touch(self, container, modified, etag=None):
+        conn = self._conn()
+        with conn:
+            row = conn.execute("SELECT metadata FROM containers WHERE name=?",
+                (container,)).fetchone()
+            if row is not None:
+                metadata = json.loads(row[0])
+                metadata['modified'] = modified
+                metadata['_etag'] = etag
+                conn.execute("UPDATE containers SET metadata=? WHERE name=?",
+                    (self._dump(metadata), container))
+
+    def drop_container(self, container):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM targets WHERE container=?", (container,))
+            conn.execute("DELETE FROM annotations WHERE container=?", (container,))
+            conn.execute("DELETE FROM containers WHERE name=?", (container,))
+            conn.execute("DELETE FROM stats WHERE container=?", (container,))
+
+    def exists(self, container, ident):
+        return self._conn().execute("SELECT 1 FROM annotations WHERE container=? AND id=?",
+            (container, ident)).fetchone() is not None
+
+    def get(self, container, ident, fields=None):
+        row = self._conn().execute("SELECT doc FROM annotations WHERE container=? AND id=?",
+            (container, ident)).fetchone()
+        if row is None:
+            return None
+        doc = json.loads(row[0])
+        doc['_id'] = ident
+        if fields:
+            doc = select_fields(doc, fields)
+        return doc
+
+    def get_many(self, container, idents):
+        idents = list(idents)
+        docs = []
+        conn = self._conn()
+        # Stay under SQLite's bound parameter limit
+        for x in range(0, len(idents), 500):
+            chunk = idents[x:x+500]
+            rows = conn.execute("SELECT id, doc FROM annotations WHERE container=? AND id IN (%s)"
+                % ",".join("?" * len(chunk)), [container] + chunk)
+            for row in rows:
+                doc = json.loads(row[1])
+                doc['_id'] = row[0]
+                docs.append(doc)
+        return docs
+
+    def insert(self, container, doc):
+        doc = dict(doc)
+        ident = doc.pop('_id')
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO annotations (container, id, doc) VALUES (?,?,?)",
+                (container, ident, self._dump(doc)))
+            self._set_targets(conn, container, ident, doc)
+
+    def insert_many(self, container, docs):
+        count = 0
+        conn = self._conn()
+        with conn:
+            for doc in docs:
+                doc = dict(doc)
+                ident = doc.pop('_id')
+                cur = conn.execute("INSERT OR IGNORE INTO annotations (container, id, doc) VALUES (?,?,?)",
+                    (container, ident, self._dump(doc)))
+                if cur.rowcount:
+                    self._set_targets(conn, container, ident, doc)
+                    count += 1
+        return count
+
+    def _current(self, conn, container, ident):
+        # The stored document, read inside a write transaction
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT doc FROM annotations WHERE container=? AND id=?",
+            (container, ident)).fetchone()
+        if row is None:
+            return None
+        old = json.loads(row[0])
+        old['_id'] = ident
+        return old
+
+    def replace(self, container, ident, doc):
+        doc = dict(doc)
+        doc.pop('_id', None)
+        conn = self._conn()
+        with conn:
+            old = self._current(conn, container, ident)
+            if old is not None:
+                conn.execute("UPDATE annotations SET doc=? WHERE container=? AND id=?",
+                    (self._dump(doc), container, ident))
+                self._set_targets(conn, container, ident, doc)
+        return old
+
+    def delete(self, container, ident):
+        conn = self._conn()
+        with conn:
+            old = self._current(conn, container, ident)
+            conn.execute("DELETE FROM targets WHERE container=? AND id=?", (container, ident))
+            conn.execute("DELETE FROM annotations WHERE container=? AND id=?", (container, ident))
+        return old
+
+    def patch(self, container, ident, patch, etag=None, new_etag=None):
+        (kind, patch) = patch
+        conn = self._conn()
+        with conn:
+            # Take the write lock before reading, so nobody else can write in between
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT doc FROM annotations WHERE container=? AND id=?",
+                (container, ident)).fetchone()
+            if row is None:
+                return None
+            old = json.loads(row[0])
+            if etag and old.get('_etag') != etag:
+                return None
+            try:
+                doc = apply_patch(old, kind, patch)
+            except PatchFailed:
+                return None
+            doc['_etag'] = new_etag
+            conn.execute("UPDATE annotations SET doc=? WHERE container=? AND id=?",
+                (self._dump(doc), container, ident))
+            self._set_targets(conn, container, ident, doc)
+        old['_id'] = ident
+        doc['_id'] = ident
+        return (old, doc)
+
+    def _where(self, container, target=None, exact=False):
+        where = "container=?"
+        params = [container]
+        if target and exact:
+            # target itself, or with a #fragment: a range rather than LIKE,
+            # which ignores case and treats _ and % as wildcards
+            where += " AND id IN (SELECT id FROM targets WHERE container=? AND (iri=? OR (iri>=? AND iri<?)))"
+            params.extend([container, target, target + u'#', target + u'$'])
+        elif target:
+            # Prefix match on the indexed IRI column
+            where += " AND id IN (SELECT id FROM targets WHERE container=? AND iri>=? AND iri<?)"
+            params.extend([container, target, target + u'\uffff'])
+        return (where, params)
+
+    def delete_matching(self, container, dry_run=False, target=None, creator=None, created_before=None):
+        (where, params) = self._where(container, target, exact=True)
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if creator or created_before:
+                rows = conn.execute("SELECT id, doc FROM annotations WHERE " + where, params)
+                idents = [r[0] for r in rows if creator_matches(json.loads(r[1]), creator, created_before)]
+            else:
+                idents = [r[0] for r in conn.execute("SELECT id FROM annotations WHERE " + where, params)]
+            if not dry_run:
+                for x in range(0, len(idents), 500):
+                    chunk = idents[x:x+500]
+                    marks = ",".join("?" * len(chunk))
+                    conn.execute("DELETE FROM targets WHERE container=? AND id IN (%s)" % marks,
+                        [container] + chunk)
+                    conn.execute("DELETE FROM annotations WHERE container=? AND id IN (%s)" % marks,
+                        [container] + chunk)
+        return len(idents)
+
+    def members(self, container):
+        rows = self._conn().execute("SELECT id, doc FROM annotations WHERE container=? ORDER BY seq",
+            (container,))
+        for row in rows:
+            doc = json.loads(row[1])
+            doc['_id'] = row[0]
+            yield doc
+
+    def get_stats(self, container):
+        rows = self._conn().execute("SELECT dim, key, n FROM stats WHERE container=?", (container,)).fetchall()
+        if not [r for r in rows if r[0] == 'total']:
+            return None
+        stats = dict([(dim, {}) for dim in stat_dimensions])
+        for (dim, k, n) in rows:
+            if dim == 'total':
+                stats['total'] = n
+            elif dim == 'stale':
+                stats['stale'] = True
+            elif n and dim in stats:
+                stats[dim][k] = n
+        return stats
+
+    def update_stats(self, container, delta):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not conn.execute("SELECT 1 FROM stats WHERE container=? AND dim='total'", (container,)).fetchone():
+                # Rebuilt when next read
+                return
+            for ((dim, k), n) in delta.items():
+                cur = conn.execute("UPDATE stats SET n=n+? WHERE container=? AND dim=? AND key=?",
+                    (n, container, dim, k))
+                if not cur.rowcount:
+                    conn.execute("INSERT INTO stats (container, dim, key, n) VALUES (?,?,?,?)",
+                        (container, dim, k, n))
+
+    def invalidate_stats(self, container):
+        # Still served until they're rebuilt
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO stats (container, dim, key, n) VALUES (?,'stale','',1)",
+                (container,))
+
+    def rebuild_stats(self, container):
+        # Counted in one transaction, so writes wait for it
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT doc FROM annotations WHERE container=?", (container,))
+            stats = count_stats(json.loads(r[0]) for r in rows)
+            conn.execute("DELETE FROM stats WHERE container=?", (container,))
+            values = [(container, 'total', '', stats['total'])]
+            for dim in stat_dimensions:
+                values.extend([(container, dim, k, n) for (k, n) in stats[dim].items()])
+            conn.executemany("INSERT INTO stats (container, dim, key, n) VALUES (?,?,?,?)", values)
+        return stats
+
+    def migrate_ids(self, container):
+        # In one transaction, so there are no copies from an earlier run
+        conn = self._conn()
+        count = 0
+        collisions = []
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            old = [r[0] for r in conn.execute("SELECT id FROM annotations WHERE container=? AND id LIKE '%/%'",
+                (container,)).fetchall()]
+            for ident in old:
+                new = ident.rsplit('/', 1)[1]
+                if conn.execute("SELECT 1 FROM annotations WHERE container=? AND id=?",
+                        (container, new)).fetchone():
+                    collisions.append(ident)
+                    continue
+                conn.execute("UPDATE annotations SET id=? WHERE container=? AND id=?", (new, container, ident))
+                conn.execute("UPDATE targets SET id=? WHERE container=? AND id=?", (new, container, ident))
+                count += 1
+        return (count, collisions)
+
+    def items(self, container, base, include, offset, limit, target=None, fields=None):
+        (where, params) = self._where(container, target)
+        conn = self._conn()
+        total = conn.execute("SELECT COUNT(*) FROM annotations WHERE " + where, params).fetchone()[0]
+        items = []
+        if limit:
+            cols = "id, doc" if include == 'description' else "id"
+            rows = conn.execute("SELECT %s FROM annotations WHERE %s ORDER BY seq LIMIT ? OFFSET ?"
+                % (cols, where), params + [limit, offset])
+            for row in rows:
+                if include == 'description':
+                    out = json.loads(row[1])
+                    if fields:
+                        out = select_fields(out, fields)
+                    out.pop('@context', None)
+                    out.pop('_etag', None)
+                else:
+                    out = {}
+                out['id'] = base + unmake_id(row[0])
+                items.append(out)
+        return (total, items)
+
+
+backends = {
+    'mongo': MongoStore,
+    'sqlite': SQLiteStore
+}
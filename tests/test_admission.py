@@ -0,0 +1,41 @@
+
+# Tests for the admission limits, on their own
+#
+#  $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mangoadmission import Admission
+
+
+class TestRates(unittest.TestCase):
+
+    def test_burst(self):
+        adm = Admission({'client_rate': 1, 'burst': 2, 'rdf_cost': 5})
+        for x in range(2):
+            self.assertTrue(adm.admit('annos', 'a', 'json')[0])
+        (held, shed) = adm.admit('annos', 'a', 'json')
+        self.assertEqual(held, None)
+        self.assertEqual(shed[0], 'client_rate')
+
+    def test_rdf_cost_over_burst(self):
+        # Needs a full bucket, and leaves it owing the rest
+        adm = Admission({'client_rate': 1, 'burst': 2, 'rdf_cost': 5})
+        self.assertTrue(adm.admit('annos', 'a', 'rdf')[0])
+        (held, shed) = adm.admit('annos', 'a', 'json')
+        self.assertEqual(held, None)
+        self.assertTrue(shed[1] >= 3)
+
+    def test_least_recently_used(self):
+        adm = Admission({'client_rate': 1, 'max_buckets': 2})
+        for client in ['a', 'b', 'a', 'c']:
+            adm.admit('annos', client, 'json')
+        self.assertEqual(list(adm.buckets.keys()), [('client', 'a'), ('client', 'c')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,502 @@
+
+# Handler tests, driving the Bottle app over WSGI. Every test case runs on
+# the SQLite backend, and again on Mongo in each storage layout when there
+# is a mongod on localhost (MANGO_TEST_MONGO=host:port for another)
+#
+#  $ python -m unittest discover tests
+
+import os
+import sys
+import json
+import time
+import datetime
+import shutil
+import tempfile
+import unittest
+import uuid
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mangoserver import MangoServer
+
+HOST = "http://localhost:8080"
+LD = {'Content-Type': 'application/ld+json'}
+
+# Name suffix and MangoServer options of each backend the test cases run on.
+# The unsuffixed cases are SQLite
+backends = [
+    ('Mongo', {'backend': 'mongo', 'storage_layout': 'collection'}),
+    ('MongoShared', {'backend': 'mongo', 'storage_layout': 'shared'})
+]
+mongo_address = os.environ.get('MANGO_TEST_MONGO', 'localhost:27017')
+_mongo_up = []
+
+def mongo_up():
+    # Whether there's a mongod to test against, asked once
+    if not _mongo_up:
+        from pymongo import MongoClient
+        try:
+            MongoClient(mongo_address, serverSelectionTimeoutMS=500).server_info()
+            _mongo_up.append(True)
+        except Exception:
+            _mongo_up.append(False)
+    return _mongo_up[0]
+
+
+class HandlerTest(unittest.TestCase):
+
+    backend_options = {'backend': 'sqlite'}
+    server_options = {}
+
+    def setUp(self):
+        self.make_server()
+        self.assertEqual(self.call('PUT', '/annos/', {'type': 'AnnotationCollection'}, LD)[0], 201)
+
+    def make_server(self):
+        self.tmp = tempfile.mkdtemp()
+        options = dict(self.backend_options, **self.server_options)
+        if options['backend'] == 'mongo':
+            if not mongo_up():
+                self.skipTest("No mongod at %s" % mongo_address)
+            (host, port) = mongo_address.split(':')
+            options.update(host=host, port=int(port), database="mango_test_" + uuid.uuid4().hex[:8])
+        else:
+            options['sqlite_path'] = os.path.join(self.tmp, 'mango.sqlite')
+        self.server = MangoServer(url_host=HOST, **options)
+        self.app = self.server.get_bottle_app()
+
+    def tearDown(self):
+        if self.backend_options['backend'] == 'mongo':
+            db = self.server.store.connection
+            db.client.drop_database(db.name)
+        shutil.rmtree(self.tmp)
+
+    def call(self, method, path, body=None, headers={}, query=''):
+        # (status code, lowercased headers, body)
+        if body is None:
+            data = ''
+        elif isinstance(body, str):
+            data = body
+        else:
+            data = json.dumps(body)
+        env = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': query,
+               'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080', 'SERVER_PROTOCOL': 'HTTP/1.1',
+               'CONTENT_LENGTH': str(len(data)), 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+               'wsgi.input': BytesIO(data), 'wsgi.errors': sys.stderr, 'wsgi.multithread': False,
+               'wsgi.multiprocess': False, 'wsgi.run_once': False, 'REMOTE_ADDR': '127.0.0.1'}
+        for (k, v) in headers.items():
+            k = k.upper().replace('-', '_')
+            env[k if k in ['CONTENT_TYPE', 'CONTENT_LENGTH'] else 'HTTP_' + k] = v
+        status = []
+        def start_response(s, h, exc=None):
+            status.append((int(s.split()[0]), dict([(k.lower(), v) for (k, v) in h])))
+        out = self.app(env, start_response)
+        data = out.read() if hasattr(out, 'read') else ''.join(out)
+        if hasattr(out, 'close'):
+            out.close()
+        return (status[0][0], status[0][1], data)
+
+    def get_json(self, path, query='', headers={}):
+        (status, hdrs, body) = self.call('GET', path, headers=headers, query=query)
+        self.assertEqual(status, 200, body)
+        return json.loads(body)
+
+    def post(self, anno, container='/annos/'):
+        # Path of the new annotation
+        (status, hdrs, body) = self.call('POST', container, anno, LD)
+        self.assertEqual(status, 201, body)
+        return hdrs['location'][len(HOST):]
+
+    def anno(self, target="http://example.org/canvas/1", **props):
+        anno = {'@context': "http://www.w3.org/ns/anno.jsonld", 'type': 'Annotation', 'target': target}
+        anno.update(props)
+        return anno
+
+
+class TestResources(HandlerTest):
+
+    def test_post_and_get(self):
+        path = self.post(self.anno(bodyValue="Hello"))
+        (status, hdrs, body) = self.call('GET', path)
+        self.assertEqual(status, 200)
+        js = json.loads(body)
+        self.assertEqual(js['id'], HOST + path)
+        self.assertEqual(js['bodyValue'], "Hello")
+        self.assertTrue(hdrs['etag'])
+        self.assertFalse('_id' in js or '_etag' in js)
+
+    def test_get_missing(self):
+        self.assertEqual(self.call('GET', '/annos/nothere')[0], 404)
+
+    def test_slug(self):
+        (status, hdrs, body) = self.call('POST', '/annos/', self.anno(), dict(LD, Slug='mine'))
+        self.assertEqual(hdrs['location'], HOST + '/annos/mine')
+        self.assertEqual(self.call('GET', '/annos/mine')[0], 200)
+
+    def test_put(self):
+        path = self.post(self.anno())
+        etag = self.call('GET', path)[1]['etag']
+        self.assertEqual(self.call('PUT', path, self.anno(bodyValue="New"), dict(LD, **{'If-Match': etag}))[0], 202)
+        self.assertEqual(self.get_json(path)['bodyValue'], "New")
+
+    def test_put_stale_etag(self):
+        path = self.post(self.anno())
+        self.assertEqual(self.call('PUT', path, self.anno(), dict(LD, **{'If-Match': 'stale'}))[0], 412)
+
+    def test_delete(self):
+        path = self.post(self.anno())
+        self.assertEqual(self.call('DELETE', path)[0], 204)
+        self.assertEqual(self.call('GET', path)[0], 404)
+
+    def test_fields(self):
+        path = self.post(self.anno(bodyValue="Hello", motivation="commenting"))
+        (status, hdrs, body) = self.call('GET', path, query='fields=target')
+        js = json.loads(body)
+        self.assertEqual(sorted(js.keys()), ['@context', 'id', 'target'])
+        self.assertNotEqual(hdrs['etag'], self.call('GET', path)[1]['etag'])
+
+    def test_bad_json(self):
+        self.assertEqual(self.call('POST', '/annos/', '{"type": ', LD)[0], 400)
+
+    def test_body_too_large(self):
+        self.server.max_body_size = 100
+        self.assertEqual(self.call('POST', '/annos/', self.anno(bodyValue="x" * 200), LD)[0], 413)
+
+    def chunked(self, data, size=16):
+        return "".join(["%x\r\n%s\r\n" % (len(data[x:x+size]), data[x:x+size])
+            for x in range(0, len(data), size)]) + "0\r\n\r\n"
+
+    def test_chunked_body(self):
+        hdrs = dict(LD, **{'Transfer-Encoding': 'chunked', 'Content-Length': ''})
+        (status, hdrs, body) = self.call('POST', '/annos/', self.chunked(json.dumps(self.anno(bodyValue="Hello"))), hdrs)
+        self.assertEqual(status, 201, body)
+        self.assertEqual(self.get_json(hdrs['location'][len(HOST):])['bodyValue'], "Hello")
+
+    def test_chunked_body_too_large(self):
+        self.server.max_body_size = 100
+        hdrs = dict(LD, **{'Transfer-Encoding': 'chunked', 'Content-Length': ''})
+        data = self.chunked(json.dumps(self.anno(bodyValue="x" * 200)))
+        self.assertEqual(self.call('POST', '/annos/', data, hdrs)[0], 413)
+
+    def test_no_length(self):
+        # Without a Content-Length or chunking there is no body to read
+        hdrs = dict(LD, **{'Content-Length': ''})
+        self.assertEqual(self.call('POST', '/annos/', json.dumps(self.anno()), hdrs)[0], 400)
+
+
+class TestUlid(HandlerTest):
+
+    server_options = {'id_strategy': 'ulid'}
+
+    def test_ulid(self):
+        paths = [self.post(self.anno()) for x in range(50)]
+        ids = [p.rsplit('/', 1)[1] for p in paths]
+        self.assertEqual(set([len(x) for x in ids]), set([26]))
+        self.assertEqual(ids, sorted(ids))
+        # All 80 bits after the time are random, down to the last character
+        self.assertTrue(len(set([x[-1] for x in ids])) > 1)
+
+
+class TestPatch(HandlerTest):
+
+    def test_merge_patch(self):
+        path = self.post(self.anno(bodyValue="Old", motivation="commenting"))
+        etag = self.call('GET', path)[1]['etag']
+        (status, hdrs, body) = self.call('PATCH', path, {'bodyValue': "New", 'motivation': None},
+            {'Content-Type': 'application/merge-patch+json', 'If-Match': etag})
+        self.assertEqual(status, 202, body)
+        js = self.get_json(path)
+        self.assertEqual(js['bodyValue'], "New")
+        self.assertFalse('motivation' in js)
+        self.assertNotEqual(hdrs['etag'], etag)
+
+    def test_patch_stale_etag(self):
+        path = self.post(self.anno())
+        self.assertEqual(self.call('PATCH', path, {'bodyValue': "New"},
+            {'Content-Type': 'application/merge-patch+json', 'If-Match': 'stale'})[0], 412)
+
+    def test_json_patch(self):
+        path = self.post(self.anno(body=[{'value': 'a'}]))
+        ops = [{'op': 'add', 'path': '/body/-', 'value': {'value': 'b'}},
+               {'op': 'replace', 'path': '/target', 'value': 'http://example.org/canvas/2'}]
+        self.assertEqual(self.call('PATCH', path, ops, {'Content-Type': 'application/json-patch+json'})[0], 202)
+        js = self.get_json(path)
+        self.assertEqual([b['value'] for b in js['body']], ['a', 'b'])
+        self.assertEqual(js['target'], 'http://example.org/canvas/2')
+
+    def test_json_patch_test_fails(self):
+        # A test of a string against an array containing it fails (RFC 6902)
+        path = self.post(self.anno(motivation=["commenting", "tagging"]))
+        ops = [{'op': 'test', 'path': '/motivation', 'value': 'commenting'},
+               {'op': 'replace', 'path': '/bodyValue', 'value': 'x'}]
+        self.assertEqual(self.call('PATCH', path, ops, {'Content-Type': 'application/json-patch+json'})[0], 409)
+
+    def test_json_patch_add_out_of_range(self):
+        path = self.post(self.anno(body=[{'value': 'a'}]))
+        ops = [{'op': 'add', 'path': '/body/5', 'value': {'value': 'b'}}]
+        self.assertEqual(self.call('PATCH', path, ops, {'Content-Type': 'application/json-patch+json'})[0], 409)
+
+    def test_json_patch_remove_through_array(self):
+        # body.id exists to a Mongo query through the array, but not to RFC 6902
+        path = self.post(self.anno(body=[{'id': 'http://example.org/body/1'}]))
+        etag = self.call('GET', path)[1]['etag']
+        ops = [{'op': 'remove', 'path': '/body/id'}]
+        self.assertEqual(self.call('PATCH', path, ops, {'Content-Type': 'application/json-patch+json'})[0], 409)
+        self.assertEqual(self.call('GET', path)[1]['etag'], etag)
+
+    def test_merge_patch_under_missing(self):
+        # RFC 7396 makes an empty object of the missing parent
+        path = self.post(self.anno())
+        self.assertEqual(self.call('PATCH', path, {'stylesheet': {'value': None}},
+            {'Content-Type': 'application/merge-patch+json'})[0], 202)
+        self.assertEqual(self.get_json(path)['stylesheet'], {})
+
+    def test_merge_patch_numeric_key(self):
+        path = self.post(self.anno(body=[{'value': 'a'}]))
+        self.assertEqual(self.call('PATCH', path, {'body': {'0': {'value': 'b'}}},
+            {'Content-Type': 'application/merge-patch+json'})[0], 202)
+        self.assertEqual(self.get_json(path)['body'], {'0': {'value': 'b'}})
+
+    def test_patch_missing(self):
+        self.assertEqual(self.call('PATCH', '/annos/nothere', {'bodyValue': "New"},
+            {'Content-Type': 'application/merge-patch+json'})[0], 404)
+
+
+class TestContainer(HandlerTest):
+
+    def test_paging(self):
+        paths = [self.post(self.anno(bodyValue=str(x))) for x in range(25)]
+        base = self.get_json('/annos/')
+        self.assertEqual(base['total'], 25)
+        self.assertEqual(len(base['first']['items']), 10)
+        seen = []
+        for page in range(3):
+            js = self.get_json('/annos/', query='include=description&page=%s' % page)
+            self.assertEqual(js['partOf']['total'], 25)
+            self.assertEqual(js['startIndex'], page * 10)
+            seen.extend([x['id'] for x in js['items']])
+        self.assertEqual(seen, [HOST + p for p in paths])
+        self.assertFalse('next' in js)
+
+    def test_iris(self):
+        path = self.post(self.anno())
+        js = self.get_json('/annos/', query='include=uri&page=0')
+        self.assertEqual(js['items'], [HOST + path])
+
+    def test_target_search(self):
+        on1 = self.post(self.anno("http://example.org/canvas/1#xywh=0,0,10,10"))
+        on2 = self.post(self.anno({'type': 'SpecificResource', 'source': "http://example.org/canvas/2"}))
+        js = self.get_json('/annos/', query='target=http://example.org/canvas/2')
+        self.assertEqual(js['total'], 1)
+        self.assertEqual([x['id'] for x in js['first']['items']], [HOST + on2])
+
+    def test_unknown_container(self):
+        self.assertEqual(self.call('GET', '/nothere/')[0], 404)
+
+    def test_conditional_get(self):
+        self.post(self.anno())
+        etag = self.call('GET', '/annos/')[1]['etag']
+        self.assertEqual(self.call('GET', '/annos/', headers={'If-None-Match': etag})[0], 304)
+        self.post(self.anno())
+        self.assertEqual(self.call('GET', '/annos/', headers={'If-None-Match': etag})[0], 200)
+
+
+class TestBatch(HandlerTest):
+
+    def test_batch_fetch(self):
+        a = self.post(self.anno())
+        b = self.post(self.anno())
+        js = self.get_json('/annos/__batch__', query='id=%s&id=%s&id=nothere' % (HOST + a, b.split('/')[-1]))
+        self.assertEqual(sorted([x['id'] for x in js['items']]), sorted([HOST + a, HOST + b]))
+        self.assertEqual(js['missing'], ['nothere'])
+        self.assertEqual(js['etags'][HOST + a], self.call('GET', a)[1]['etag'])
+
+    def test_batch_post(self):
+        a = self.post(self.anno())
+        (status, hdrs, body) = self.call('POST', '/annos/__batch__', [HOST + a], LD)
+        self.assertEqual(status, 200)
+        self.assertEqual([x['id'] for x in json.loads(body)['items']], [HOST + a])
+
+    def test_bulk_delete_needs_criteria(self):
+        self.assertEqual(self.call('DELETE', '/annos/__batch__')[0], 400)
+
+    def test_bulk_delete_by_creator(self):
+        mine = self.post(self.anno(creator="http://example.org/me"))
+        other = self.post(self.anno(creator={'id': "http://example.org/you"}))
+        js = json.loads(self.call('DELETE', '/annos/__batch__', query='creator=http://example.org/me&dryRun=true')[2])
+        self.assertEqual(js['matched'], 1)
+        self.assertEqual(self.call('GET', mine)[0], 200)
+        js = json.loads(self.call('DELETE', '/annos/__batch__', query='creator=http://example.org/me')[2])
+        self.assertEqual(js['removed'], 1)
+        self.assertEqual(self.call('GET', mine)[0], 404)
+        self.assertEqual(self.call('GET', other)[0], 200)
+
+    def test_bulk_delete_by_target(self):
+        one = self.post(self.anno("http://example.org/canvas/1"))
+        frag = self.post(self.anno({'source': "http://example.org/canvas/1#xywh=0,0,1,1"}))
+        ten = self.post(self.anno("http://example.org/canvas/10"))
+        for prefix in ['http', '.', 'http://example.org/canvas/']:
+            js = json.loads(self.call('DELETE', '/annos/__batch__', query='target=%s&dryRun=true' % prefix)[2])
+            self.assertEqual(js['matched'], 0)
+        js = json.loads(self.call('DELETE', '/annos/__batch__', query='target=http://example.org/canvas/1')[2])
+        self.assertEqual(js['removed'], 2)
+        self.assertEqual(self.call('GET', one)[0], 404)
+        self.assertEqual(self.call('GET', frag)[0], 404)
+        self.assertEqual(self.call('GET', ten)[0], 200)
+
+
+class TestStats(HandlerTest):
+
+    def test_stats(self):
+        a = self.post(self.anno("http://example.org/canvas/1#xywh=0,0,1,1", motivation="commenting",
+            creator={'id': "http://example.org/me"}))
+        b = self.post(self.anno({'source': "http://example.org/canvas/2"}, motivation=["tagging", "commenting"]))
+        self.post(self.anno("http://example.org/canvas/1"))
+        js = self.get_json('/annos/__stats__')
+        self.assertEqual(js['total'], 3)
+        self.assertEqual(js['motivation'], {'commenting': 2, 'tagging': 1})
+        self.assertEqual(js['creator'], {'http://example.org/me': 1})
+        self.assertEqual(js['canvas'], {'http://example.org/canvas/1': 2, 'http://example.org/canvas/2': 1})
+        self.assertEqual(sum(js['day'].values()), 3)
+
+        self.call('PUT', a, self.anno("http://example.org/canvas/3", motivation="describing"), LD)
+        self.call('DELETE', b)
+        js = self.get_json('/annos/__stats__')
+        self.assertEqual(js['total'], 2)
+        self.assertEqual(js['motivation'], {'describing': 1})
+        self.assertEqual(js['canvas'], {'http://example.org/canvas/1': 1, 'http://example.org/canvas/3': 1})
+
+        # The maintained counters agree with a recount
+        recount = self.server.store.rebuild_stats('annos')
+        for k in ['total', 'motivation', 'creator', 'canvas', 'day']:
+            self.assertEqual(js[k], recount[k])
+
+    def test_stats_patch(self):
+        # Counted from the old document, rather than dropping the counters
+        path = self.post(self.anno(motivation="commenting"))
+        self.call('PATCH', path, {'motivation': "tagging", 'target': "http://example.org/canvas/2"},
+            {'Content-Type': 'application/merge-patch+json'})
+        ops = [{'op': 'add', 'path': '/creator', 'value': "http://example.org/me"}]
+        self.call('PATCH', path, ops, {'Content-Type': 'application/json-patch+json'})
+        stats = self.server.store.get_stats('annos')
+        self.assertNotEqual(stats, None)
+        self.assertEqual(stats['motivation'], {'tagging': 1})
+        self.assertEqual(stats['canvas'], {'http://example.org/canvas/2': 1})
+        self.assertEqual(stats['creator'], {'http://example.org/me': 1})
+
+    def test_stats_stale(self):
+        # Served as they were, while recounted in the background
+        self.post(self.anno(creator="http://example.org/me"))
+        self.post(self.anno())
+        self.assertEqual(self.call('DELETE', '/annos/__batch__', query='creator=http://example.org/me')[0], 200)
+        self.assertEqual(self.server.store.get_stats('annos')['stale'], True)
+        js = self.get_json('/annos/__stats__')
+        self.assertEqual(js['total'], 2)
+        self.assertFalse('stale' in js)
+        for x in range(500):
+            if not self.server._rebuilding:
+                break
+            time.sleep(0.01)
+        js = self.get_json('/annos/__stats__')
+        self.assertEqual(js['total'], 1)
+        self.assertEqual(js['creator'], {})
+        self.assertFalse('stale' in self.server.store.get_stats('annos'))
+
+    def test_stats_rebuild_lease(self):
+        if self.backend_options['backend'] != 'mongo':
+            self.skipTest("SQLite rebuilds in a transaction")
+        stats = self.server.store.connection[self.server.store.stats_collection]
+        stats.insert_one({'_id': {'rebuild': 'annos'},
+            'until': datetime.datetime.utcnow() + datetime.timedelta(seconds=60)})
+        self.assertEqual(self.server.store.rebuild_stats('annos'), None)
+        stats.delete_one({'_id': {'rebuild': 'annos'}})
+        self.assertEqual(self.server.store.rebuild_stats('annos')['total'], 0)
+
+
+class TestPublish(HandlerTest):
+
+    def setUp(self):
+        HandlerTest.setUp(self)
+        self.server.publish_dir = os.path.join(self.tmp, 'published')
+        self.server.publish_variants = {'jsonld': ''}
+        self.server.description_page_size = 2
+        self.server.uri_page_size = 3
+
+    def test_publish(self):
+        for n in range(7):
+            self.post(self.anno("http://example.org/canvas/%s" % n))
+        [(name, stats)] = self.server.publish()
+        # base and 4 pages of descriptions, base and 3 pages of uris, 7 annotations
+        self.assertEqual(stats, {'rendered': 16, 'kept': 0, 'removed': 0})
+        queries = ['include=description', 'include=uri'] + \
+            ['include=description&page=%s' % n for n in range(4)] + ['include=uri&page=%s' % n for n in range(3)]
+        published = [self.call('GET', '/annos/', query=query) for query in queries]
+        # The same as rendering them
+        self.server.publish_dir = None
+        for (n, query) in enumerate(queries):
+            live = self.call('GET', '/annos/', query=query)
+            self.assertEqual(json.loads(published[n][2]), json.loads(live[2]), query)
+            self.assertEqual(published[n][1]['etag'], live[1]['etag'])
+
+    def test_republish(self):
+        first = self.post(self.anno())
+        self.post(self.anno())
+        self.server.publish()
+        self.assertEqual(self.server.publish(), [('annos', None)])
+        self.call('DELETE', first)
+        # The annotation and the second page of descriptions go
+        self.assertEqual(self.server.publish()[0][1], {'rendered': 4, 'kept': 1, 'removed': 2})
+
+
+class TestMigrateIds(HandlerTest):
+
+    def test_migrate_ids(self):
+        store = self.server.store
+        store.insert('annos', {'_id': HOST + '/annos/old', '_etag': 'x', 'target': "http://example.org/canvas/1"})
+        # The new id of this one is taken by something else
+        store.insert('annos', {'_id': HOST + '/annos/taken', '_etag': 'y', 'bodyValue': "Old"})
+        store.insert('annos', {'_id': 'taken', '_etag': 'z', 'bodyValue': "New"})
+        self.assertEqual(store.migrate_ids('annos'), (1, [HOST + '/annos/taken']))
+        self.assertEqual(self.get_json('/annos/old')['target'], "http://example.org/canvas/1")
+        self.assertEqual(self.get_json('/annos/taken')['bodyValue'], "New")
+        self.assertEqual(store.get('annos', HOST + '/annos/taken')['bodyValue'], "Old")
+        self.assertEqual(self.get_json('/annos/', query='target=http://example.org/canvas/1')['total'], 1)
+
+
+class TestMetrics(HandlerTest):
+
+    server_options = {'url_prefix': 'annotations/', 'admission': {'max_in_flight': 10}}
+
+    def setUp(self):
+        self.make_server()
+
+    def test_metrics(self):
+        self.assertEqual(self.call('PUT', '/annotations/annos/', {'type': 'AnnotationCollection'}, LD)[0], 201)
+        js = self.get_json('/__metrics__')
+        self.assertEqual(js['admitted'], 1)
+        self.assertEqual(js['limits']['max_in_flight'], 10)
+
+
+class TestMigrateToShared(HandlerTest):
+
+    def test_migrate_to_shared(self):
+        if self.backend_options.get('storage_layout') != 'collection':
+            self.skipTest("Only from Mongo's collection layout")
+        path = self.post(self.anno(bodyValue="Hello"))
+        self.post(self.anno())
+        self.assertEqual(self.server.store.migrate_to_shared(), [('annos', 2)])
+        self.server.store.storage_layout = 'shared'
+        self.assertEqual(self.get_json(path)['bodyValue'], "Hello")
+        self.assertEqual(self.get_json('/annos/')['total'], 2)
+
+
+# Each test case again on every other backend, eg TestResourcesMongoShared
+for (name, case) in globals().items():
+    if name.startswith('Test') and issubclass(case, HandlerTest):
+        for (suffix, options) in backends:
+            globals()[name + suffix] = type(name + suffix, (case,), {'backend_options': options})
+
+
+if __name__ == "__main__":
+    unittest.main()
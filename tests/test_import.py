@@ -0,0 +1,124 @@
+
+# Tests for the bulk RDF import: the statement splitters, and importing
+# into a container on the SQLite backend
+#
+#  $ python -m unittest discover tests
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mangoserver import MangoServer
+from mangoimport import ntriples_statements, turtle_statements, import_rdf, BNODE_NS
+
+HOST = "http://localhost:8080"
+
+
+def split(splitter, text):
+    return list(splitter(io.StringIO(text)))
+
+
+class TestNTriples(unittest.TestCase):
+
+    def test_statements(self):
+        stmts = split(ntriples_statements, u'# A comment\n\n'
+            u'<http://ex.org/a> <http://ex.org/p> <http://ex.org/b> .\n'
+            u'<http://ex.org/a> <http://ex.org/p> "b" .\n')
+        self.assertEqual(stmts, [
+            (False, u'<http://ex.org/a> <http://ex.org/p> <http://ex.org/b> .\n'),
+            (False, u'<http://ex.org/a> <http://ex.org/p> "b" .\n')])
+
+    def test_bnodes(self):
+        stmts = split(ntriples_statements, u'_:b0 <http://ex.org/p> _:b1 .\n'
+            u'_:b0 <http://ex.org/p> "not _:b2" .\n')
+        self.assertEqual(stmts, [
+            (False, u'<%sb0> <http://ex.org/p> <%sb1> .\n' % (BNODE_NS, BNODE_NS)),
+            (False, u'<%sb0> <http://ex.org/p> "not _:b2" .\n' % BNODE_NS)])
+
+
+class TestTurtle(unittest.TestCase):
+
+    def test_directives(self):
+        stmts = split(turtle_statements, u'@prefix ex: <http://ex.org/> .\n'
+            u'PREFIX oa: <http://www.w3.org/ns/oa#>\n'
+            u'ex:a ex:p ex:b .\n')
+        self.assertEqual([(d, s.strip()) for (d, s) in stmts], [
+            (True, u'@prefix ex: <http://ex.org/> .'),
+            (True, u'PREFIX oa: <http://www.w3.org/ns/oa#>'),
+            (False, u'ex:a ex:p ex:b .')])
+
+    def test_full_stops(self):
+        # Only a full stop outside of IRIs, strings and brackets, that isn't
+        # in a number, ends a statement
+        stmts = split(turtle_statements, u'ex:a ex:p <http://ex.org/x.y#z> , "a. b" ;\n'
+            u'  ex:q """c.\nd.""" , [ ex:r 1.5 ] . ex:b ex:p \'e.\' .\n')
+        self.assertEqual([s.strip() for (d, s) in stmts], [
+            u'ex:a ex:p <http://ex.org/x.y#z> , "a. b" ;\n  ex:q """c.\nd.""" , [ ex:r 1.5 ] .',
+            u'ex:b ex:p \'e.\' .'])
+
+    def test_comments(self):
+        stmts = split(turtle_statements, u'ex:a ex:p "# not a comment" . # a comment.\n'
+            u'# ex:b ex:p ex:c .\n')
+        self.assertEqual([s.strip() for (d, s) in stmts], [u'ex:a ex:p "# not a comment" .'])
+
+    def test_bnodes(self):
+        stmts = split(turtle_statements, u'_:b0 ex:p [ ex:q _:b1 ], "_:b2" .\n')
+        self.assertEqual(stmts[0][1].strip(), u'<%sb0> ex:p [ ex:q <%sb1> ], "_:b2" .' % (BNODE_NS, BNODE_NS))
+
+    def test_unterminated(self):
+        self.assertRaises(ValueError, split, turtle_statements, u'ex:a ex:p ex:b\n')
+
+
+class TestImport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = MangoServer(backend='sqlite', sqlite_path=os.path.join(self.tmp, 'mango.sqlite'),
+            url_host=HOST)
+        self.server.store.create_container('annos', {'type': 'AnnotationCollection'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        fh = io.open(path, 'w', encoding='utf-8')
+        fh.write(text)
+        fh.close()
+        return path
+
+    def test_import(self):
+        source = self.write('annos.ttl', u'@prefix oa: <http://www.w3.org/ns/oa#> .\n'
+            u'<http://ex.org/anno/1> a oa:Annotation ; oa:hasTarget <http://ex.org/canvas/1> .\n'
+            u'_:b0 a oa:Annotation ; oa:hasTarget <http://ex.org/canvas/2> .\n')
+        state = import_rdf(self.server, 'annos', source, batch_size=1)
+        self.assertEqual((state['imported'], state['existing'], state['failed']), (2, 0, 0))
+        self.assertEqual(sorted([x['target'] for x in self.server.store.members('annos')]),
+            ['http://ex.org/canvas/1', 'http://ex.org/canvas/2'])
+        # Only the checkpoint is left behind
+        self.assertTrue(os.path.exists(source + '.import-checkpoint'))
+        self.assertFalse(os.path.exists(source + '.import-checkpoint.triples'))
+        # and running it again finds them all imported
+        os.remove(source + '.import-checkpoint')
+        state = import_rdf(self.server, 'annos', source)
+        self.assertEqual((state['imported'], state['existing']), (0, 2))
+
+    def test_bnode_labels_per_file(self):
+        # The same blank node label in two files is two annotations
+        ttl = self.write('a.ttl', u'@prefix oa: <http://www.w3.org/ns/oa#> .\n'
+            u'_:b0 a oa:Annotation ; oa:hasTarget <http://ex.org/canvas/1> .\n')
+        nt = self.write('b.nt', u'_:b0 <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> '
+            u'<http://www.w3.org/ns/oa#Annotation> .\n'
+            u'_:b0 <http://www.w3.org/ns/oa#hasTarget> <http://ex.org/canvas/2> .\n')
+        self.assertEqual(import_rdf(self.server, 'annos', ttl)['imported'], 1)
+        self.assertEqual(import_rdf(self.server, 'annos', nt)['imported'], 1)
+        self.assertEqual(len(list(self.server.store.members('annos'))), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()